@@ -2,11 +2,17 @@ import sys
 import os
 import shutil
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 import xml.etree.ElementTree as ET
-import xml.dom.minidom as minidom
+from xml.sax.saxutils import escape, quoteattr
+import re
 import threading
+import itertools
+import atexit
 from threading import Thread
+from collections import OrderedDict, deque
+import math
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
 import logging
 logger = logging.getLogger("MacReplay")
 logger.setLevel(logging.INFO)
@@ -40,21 +46,22 @@ else:
     # If running as a regular script, use the script's current directory
     app_dir = os.path.dirname(os.path.abspath(__file__))
 
-# Paths to ffmpeg.exe and ffprobe.exe in the root folder
+# Path to ffmpeg.exe in the root folder
 ffmpeg_path = os.path.join(app_dir, 'ffmpeg', 'ffmpeg.exe')
-ffprobe_path = os.path.join(app_dir, 'ffmpeg', 'ffprobe.exe')
 
-# Check if the files exist (for debugging purposes)
-if not os.path.exists(ffmpeg_path) or not os.path.exists(ffprobe_path):
-    logger.error("Error: ffmpeg.exe or ffprobe.exe not found!")
+# Check if the file exists (for debugging purposes)
+if not os.path.exists(ffmpeg_path):
+    logger.error("Error: ffmpeg.exe not found!")
 #else:
 #    print(f"Found ffmpeg at {ffmpeg_path}")
-#    print(f"Found ffprobe at {ffprobe_path}")
 
 import flask
 from flask import Flask, jsonify
 import stb
 import json
+import gzip
+import hashlib
+import sqlite3
 import subprocess
 import uuid
 import xml.etree.cElementTree as ET
@@ -98,13 +105,15 @@ os.makedirs(os.path.dirname(configFile), exist_ok=True)
 
 logger.info(f"Using config file: {configFile}")
 
-occupied = {}
+occupied = {}  # Portal id -> {stream id: stream}
+portalsVersion = 0  # Bumped on every portal save
 config = {}
-cached_lineup = []
-cached_playlist = None
-last_playlist_host = None
+cached_lineup = None
+compiled_playlist = None
+playlistCaches = OrderedDict()
+playlistCacheHosts = 16
+playlistLock = threading.Lock()
 cached_xmltv = None
-last_updated = 0
 
 
 d_ffmpegcmd = [
@@ -136,8 +145,12 @@ defaultSettings = {
     "stream method": "ffmpeg",
     "ffmpeg command": "-re -http_proxy <proxy> -timeout <timeout> -i <url> -map 0 -codec copy -f mpegts -flush_packets 0 -fflags +nobuffer -flags low_delay -strict experimental -analyzeduration 0 -probesize 32 -copyts -threads 12 pipe:",
     "ffmpeg timeout": "5",
+    "stream chunk size": "65424",
     "test streams": "true",
     "try all macs": "true",
+    "parallel tunes": "3",
+    "linger time": "10",
+    "warm channels": "0",
     "use channel genres": "true",
     "use channel numbers": "true",
     "sort playlist by channel genre": "false",
@@ -150,6 +163,8 @@ defaultSettings = {
     "hdhr name": "MacReplay",
     "hdhr id": str(uuid.uuid4().hex),
     "hdhr tuners": "10",
+    "refresh interval": "15",
+    "connection pool size": "32",
 }
 
 defaultPortal = {
@@ -204,8 +219,7 @@ def loadConfig():
 
     data["portals"] = portalsOut
 
-    with open(configFile, "w") as f:
-        json.dump(data, f, indent=4)
+    writeConfig(data)
 
     return data
 
@@ -215,9 +229,10 @@ def getPortals():
 
 
 def savePortals(portals):
-    with open(configFile, "w") as f:
-        config["portals"] = portals
-        json.dump(config, f, indent=4)
+    global portalsVersion
+    config["portals"] = portals
+    portalsVersion += 1
+    saveConfig()
 
 
 def getSettings():
@@ -225,9 +240,55 @@ def getSettings():
 
 
 def saveSettings(settings):
-    with open(configFile, "w") as f:
-        config["settings"] = settings
-        json.dump(config, f, indent=4)
+    config["settings"] = settings
+    saveConfig()
+
+
+# Config persistence #
+# Saves only mark the config as changed, a timer writes it out once the
+# changes settle so a burst of saves costs a single write.
+
+
+configLock = threading.Lock()
+configWriteLock = threading.Lock()
+configTimer = None
+configWriteDelay = 2  # Seconds
+
+
+def writeConfig(data):
+    # Write a temp file and swap it in, so the config is never half written
+    temp_file = configFile + ".tmp"
+    with configWriteLock:
+        with open(temp_file, "w") as f:
+            json.dump(data, f, indent=4)
+        replaceFile(temp_file, configFile)
+
+
+def saveConfig():
+    global configTimer
+    with configLock:
+        if configTimer is None:
+            configTimer = threading.Timer(configWriteDelay, flushConfig)
+            configTimer.daemon = True
+            configTimer.start()
+
+
+def flushConfig():
+    global configTimer
+    with configLock:
+        if configTimer is None:
+            return
+        configTimer.cancel()
+        configTimer = None
+    try:
+        writeConfig(config)
+    except Exception as e:
+        # Most likely the config changed while it was being written
+        logger.error("Error saving config: {}".format(e))
+        saveConfig()
+
+
+atexit.register(flushConfig)
 
 
 def authorise(f):
@@ -255,14 +316,361 @@ def authorise(f):
     return decorated
 
 
-def moveMac(portalId, mac):
+# Occupancy #
+# Every running upstream holds one entry, keyed by a stream id, along with a
+# count per MAC. A tune reserves its MAC before resolving the link, so two
+# tunes can never both take the last slot; the upstream then takes over the
+# reservation, or the tune releases it. Each portal has its own lock so tunes
+# on different portals never wait on each other.
+
+
+occupiedMacs = {}
+occupiedLocks = {}
+occupiedLock = threading.Lock()
+streamIds = itertools.count(1)
+
+
+def getOccupiedLock(portalId):
+    with occupiedLock:
+        return occupiedLocks.setdefault(portalId, threading.Lock())
+
+
+def reserveMac(portalId, mac, streamsPerMac):
+    # Takes a slot on the MAC if it has one left, 0 streams per MAC is no limit
+    with getOccupiedLock(portalId):
+        macs = occupiedMacs.setdefault(portalId, {})
+        if streamsPerMac != 0 and macs.get(mac, 0) >= streamsPerMac:
+            return False
+        macs[mac] = macs.get(mac, 0) + 1
+    return True
+
+
+def releaseMac(portalId, mac):
+    # Gives back a reservation that never became a stream
+    with getOccupiedLock(portalId):
+        macs = occupiedMacs[portalId]
+        macs[mac] -= 1
+        if macs[mac] == 0:
+            del macs[mac]
+
+
+def occupy(portalId, stream):
+    # The stream takes over the reservation on its MAC
+    streamId = next(streamIds)
+    with getOccupiedLock(portalId):
+        occupied.setdefault(portalId, {})[streamId] = stream
+    logger.info("Occupied Portal({}):MAC({})".format(portalId, stream["mac"]))
+    return streamId
+
+
+def unoccupy(portalId, streamId):
+    with getOccupiedLock(portalId):
+        stream = occupied.get(portalId, {}).pop(streamId, None)
+        if stream is None:
+            return
+        macs = occupiedMacs[portalId]
+        macs[stream["mac"]] -= 1
+        if macs[stream["mac"]] == 0:
+            del macs[stream["mac"]]
+    logger.info("Unoccupied Portal({}):MAC({})".format(portalId, stream["mac"]))
+
+
+def getOccupiedMacs(portalId):
+    with getOccupiedLock(portalId):
+        return dict(occupiedMacs.get(portalId, {}))
+
+
+def getOccupied():
+    # A copy for readers, so nothing iterates the live entries
+    with occupiedLock:
+        portalIds = list(occupiedLocks)
+    snapshot = {}
+    for portalId in portalIds:
+        with getOccupiedLock(portalId):
+            snapshot[portalId] = [dict(stream) for stream in occupied.get(portalId, {}).values()]
+    return snapshot
+
+
+# MAC scheduler #
+# Live stats for every MAC are kept in memory. Tunes go to the least busy
+# healthy MAC, and a failing MAC sits out for a while instead of being moved
+# to the end of the config.
+
+
+macStats = {}
+macStatsLock = threading.Lock()
+macCooldown = 60  # Seconds a failing MAC sits out, doubled for each failure in a row
+macCooldownMax = 900
+expiryFormats = ["%B %d, %Y, %I:%M %p", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"]
+
+
+def parseExpiry(expiry):
+    for expiryFormat in expiryFormats:
+        try:
+            return datetime.strptime(expiry, expiryFormat).timestamp()
+        except (TypeError, ValueError):
+            pass
+
+
+def getMacStats(portalId, mac):
+    # Caller holds macStatsLock
+    return macStats.setdefault(portalId, {}).setdefault(
+        mac, {"failures": 0, "cooldown until": 0, "latency": None}
+    )
+
+
+def macSucceeded(portalId, mac, latency):
+    with macStatsLock:
+        stats = getMacStats(portalId, mac)
+        stats["failures"] = 0
+        stats["cooldown until"] = 0
+        if stats["latency"] is None:
+            stats["latency"] = latency
+        else:
+            stats["latency"] = stats["latency"] * 0.7 + latency * 0.3
+
+
+def macFailed(portalId, mac):
+    with macStatsLock:
+        stats = getMacStats(portalId, mac)
+        stats["failures"] += 1
+        cooldown = min(macCooldownMax, macCooldown * 2 ** (stats["failures"] - 1))
+        stats["cooldown until"] = time.time() + cooldown
+    logger.info("MAC({}) for Portal({}) cooling down for {}s".format(mac, portalId, cooldown))
+
+
+def orderMacs(portalId, streamsPerMac):
+    # Free MACs in the order to try them: healthy before cooling down or
+    # expired, then least busy, fewest failures and fastest
+    now = time.time()
+    active = getOccupiedMacs(portalId)
+    candidates = []
+    with macStatsLock:
+        for mac, expiry in getPortals()[portalId]["macs"].items():
+            stats = getMacStats(portalId, mac)
+            if streamsPerMac != 0 and active.get(mac, 0) >= streamsPerMac:
+                continue
+            expires = parseExpiry(expiry)
+            candidates.append(
+                (
+                    (
+                        stats["cooldown until"] > now,
+                        expires is not None and expires < now,
+                        active.get(mac, 0),
+                        stats["failures"],
+                        stats["latency"] or 0,
+                    ),
+                    mac,
+                )
+            )
+    candidates.sort(key=lambda candidate: candidate[0])
+    return [mac for order, mac in candidates]
+
+
+# Channel catalog cache #
+# One snapshot of channels and genres per portal, shared by every route that
+# needs the channel list. Stale snapshots are served while a background
+# thread refetches them. A portal that fails to answer is left alone for a
+# while, so a dead portal is not hit on every request.
+
+
+catalogs = {}
+catalogGenerations = {}
+catalogFetchLocks = {}
+catalogFailures = {}  # Portal -> (failures in a row, time of the next try)
+catalogLock = threading.Lock()
+catalogTtl = 3600  # Seconds before a portal's channel list is refetched
+catalogRetry = 60  # Seconds before a failed fetch is tried again, doubled for each failure in a row
+
+
+def getCatalogFetchLock(portalId):
+    with catalogLock:
+        return catalogFetchLocks.setdefault(portalId, threading.Lock())
+
+
+def fetchCatalog(portalId):
+    portal = getPortals().get(portalId)
+    if not portal:
+        return None
+
+    with catalogLock:
+        generation = catalogGenerations.get(portalId, 0)
+
+    name = portal["name"]
+    url = portal["url"]
+    macs = list(portal["macs"].keys())
+    proxy = portal["proxy"]
+    allChannels = None
+    genres = None
+
+    for mac in macs:
+        try:
+            allChannels = stb.withToken(stb.getAllChannels, url, mac, proxy=proxy)
+            genres = stb.withToken(stb.getGenreNames, url, mac, proxy=proxy)
+        except Exception as e:
+            allChannels = None
+            genres = None
+            logger.error(f"Error fetching channels for Portal({name}) with MAC({mac}): {e}")
+        if allChannels:
+            break
+
+    if not allChannels:
+        with catalogLock:
+            failures = catalogFailures.get(portalId, (0, 0))[0] + 1
+            retry = min(catalogTtl, catalogRetry * 2 ** (failures - 1))
+            catalogFailures[portalId] = (failures, time.time() + retry)
+        logger.error("Error getting channel catalog for Portal({}), retrying in {}s".format(name, retry))
+        return None
+
+    entry = {
+        "channels": allChannels,
+        "genres": genres or {},
+        "index": {str(c["id"]): c for c in allChannels},
+        "updated": time.time(),
+    }
+
+    with catalogLock:
+        # Drop the result if the portal was edited while we were fetching
+        if catalogGenerations.get(portalId, 0) != generation:
+            return entry
+        catalogs[portalId] = entry
+        catalogFailures.pop(portalId, None)
+
+    logger.info(
+        "Channel catalog for Portal({}) cached, {} channels".format(
+            name, len(allChannels)
+        )
+    )
+    return entry
+
+
+def refreshCatalog(portalId):
+    lock = getCatalogFetchLock(portalId)
+    if not lock.acquire(blocking=False):
+        return  # Another thread is already refetching this portal
+    try:
+        fetchCatalog(portalId)
+    finally:
+        lock.release()
+
+
+def getCatalog(portalId):
+    with catalogLock:
+        entry = catalogs.get(portalId)
+        failure = catalogFailures.get(portalId)
+    backingOff = failure is not None and time.time() < failure[1]
+
+    if entry is None:
+        if backingOff:
+            return None
+        # Nothing cached yet, so fetch while concurrent callers wait for us
+        with getCatalogFetchLock(portalId):
+            with catalogLock:
+                entry = catalogs.get(portalId)
+            if entry is None:
+                entry = fetchCatalog(portalId)
+        return entry
+
+    if time.time() - entry["updated"] > catalogTtl and not backingOff:
+        Thread(target=refreshCatalog, args=(portalId,), daemon=True).start()
+
+    return entry
+
+
+def findChannel(portalId, channelId):
+    catalog = getCatalog(portalId)
+    if catalog:
+        return catalog["index"].get(str(channelId))
+
+
+def invalidateCatalog(portalId):
+    with catalogLock:
+        catalogs.pop(portalId, None)
+        catalogFailures.pop(portalId, None)
+        catalogGenerations[portalId] = catalogGenerations.get(portalId, 0) + 1
+
+
+# Portal refresh workers #
+# The guide, lineup and playlist builders fetch each portal in its own worker
+# so a refresh only takes as long as the slowest portal.
+
+
+refreshWorkers = 6  # Portals fetched at the same time
+portalTimeout = 120  # Seconds before a slow portal is left out of a refresh
+
+
+def getEnabledPortals():
     portals = getPortals()
-    macs = portals[portalId]["macs"]
-    x = macs[mac]
-    del macs[mac]
-    macs[mac] = x
-    portals[portalId]["macs"] = macs
-    savePortals(portals)
+    return [
+        portal
+        for portal in portals
+        if portals[portal]["enabled"] == "true"
+        and len(portals[portal].get("enabled channels", [])) != 0
+    ]
+
+
+def runPortals(builder, portalIds, *args):
+    # At most refreshWorkers portals are fetched at once. The executor has a
+    # thread for every portal, so a portal starts as soon as it is submitted
+    # and one that times out gives its slot to the next in the queue.
+    queue = deque(portalIds)
+    executor = ThreadPoolExecutor(max_workers=max(1, len(queue)))
+    pending = {}  # Future -> (portal, time submitted)
+    results = {}
+
+    while queue or pending:
+        while queue and len(pending) < refreshWorkers:
+            portalId = queue.popleft()
+            pending[executor.submit(builder, portalId, *args)] = (portalId, time.time())
+
+        done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+        for future in done:
+            portalId, submitted = pending.pop(future)
+            try:
+                results[portalId] = future.result()
+            except Exception as e:
+                logger.error("Error refreshing Portal({}): {}".format(portalId, e))
+
+        now = time.time()
+        for future, (portalId, submitted) in list(pending.items()):
+            if now - submitted > portalTimeout:
+                name = getPortals().get(portalId, {}).get("name", portalId)
+                logger.error("Portal({}) timed out, skipping".format(name))
+                del pending[future]
+
+    # Timed out workers are left to finish on their own
+    executor.shutdown(wait=False)
+    return results
+
+
+# Per-portal parts #
+# The guide, lineup and playlist keep what each portal contributed, so a
+# change to one portal only rebuilds that portal's part.
+
+
+portalParts = {"xmltv": {}, "lineup": {}, "playlist": {}}
+portalPartsLock = threading.Lock()
+
+
+def updateParts(name, builder, portalIds, *args, keep=None):
+    # Rebuild the parts of portalIds (every portal when None), and of any
+    # portal that has no part yet. Returns every enabled portal's part in
+    # portal order, along with the fresh results.
+    enabled = getEnabledPortals()
+    parts = portalParts[name]
+    with portalPartsLock:
+        stale = [
+            portal
+            for portal in enabled
+            if portalIds is None or portal in portalIds or portal not in parts
+        ]
+    results = runPortals(builder, stale, *args)
+    with portalPartsLock:
+        for portal, result in results.items():
+            parts[portal] = keep(result) if keep else result
+        for portal in [portal for portal in parts if portal not in enabled]:
+            del parts[portal]
+        return [parts[portal] for portal in enabled if portal in parts], results
 
 
 @app.route("/", methods=["GET"])
@@ -277,11 +685,101 @@ def portals():
     return render_template("portals.html", portals=getPortals())
 
 
+# MAC validation jobs #
+# Adding or updating a portal tests its MACs in the background, a few at a
+# time. The portals page polls the job and the config is only changed once
+# every MAC has been tested.
+
+
+macJobs = {}
+macJobsLock = threading.Lock()
+macTestWorkers = 8
+macJobKeep = 3600  # Seconds a finished job can still be polled
+
+
+def testMac(url, mac, proxy):
+    started = time.time()
+    expiry = None
+    token = stb.getCachedToken(url, mac, proxy, renew=True)
+    if token:
+        expiry = stb.withToken(stb.getExpires, url, mac, proxy=proxy)
+    return expiry, time.time() - started
+
+
+def startMacJob(name, url, proxy, macs, apply):
+    job = {
+        "id": uuid.uuid4().hex,
+        "name": name,
+        "total": len(macs),
+        "done": 0,
+        "results": {},
+        "finished": False,
+        "status": None,
+        "message": None,
+        "updated": time.time(),
+    }
+    with macJobsLock:
+        for id in [id for id, j in macJobs.items() if j["finished"] and time.time() - j["updated"] > macJobKeep]:
+            del macJobs[id]
+        macJobs[job["id"]] = job
+    Thread(target=runMacJob, args=(job, url, proxy, macs, apply), daemon=True).start()
+    return job["id"]
+
+
+def runMacJob(job, url, proxy, macs, apply):
+    name = job["name"]
+    try:
+        if not url.endswith(".php"):
+            url = stb.getUrl(url, proxy)
+        if not url:
+            logger.error("Error getting URL for Portal({})".format(name))
+            status, message = "danger", "Error getting URL for Portal({})".format(name)
+        else:
+            with ThreadPoolExecutor(max_workers=macTestWorkers) as executor:
+                futures = {executor.submit(testMac, url, mac, proxy): mac for mac in macs}
+                for future in as_completed(futures):
+                    mac = futures[future]
+                    try:
+                        expiry, latency = future.result()
+                    except Exception as e:
+                        logger.error("Error testing MAC({}) for Portal({}): {}".format(mac, name, e))
+                        expiry, latency = None, None
+                    if expiry:
+                        logger.info("Successfully tested MAC({}) for Portal({})".format(mac, name))
+                    else:
+                        logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
+                    with macJobsLock:
+                        job["results"][mac] = {"expiry": expiry, "latency": latency}
+                        job["done"] += 1
+                        job["updated"] = time.time()
+            tested = {mac: r["expiry"] for mac, r in job["results"].items() if r["expiry"]}
+            status, message = apply(url, tested)
+    except Exception as e:
+        logger.error("Error testing MACs for Portal({}): {}".format(name, e))
+        status, message = "danger", "Error testing MACs for Portal({})".format(name)
+
+    with macJobsLock:
+        job["finished"] = True
+        job["status"] = status
+        job["message"] = message
+        job["updated"] = time.time()
+
+
+@app.route("/portal/job/<id>", methods=["GET"])
+@authorise
+def portalJob(id):
+    with macJobsLock:
+        job = macJobs.get(id)
+        if job:
+            job = dict(job, results=dict(job["results"]))
+    if not job:
+        return make_response("Job not found", 404)
+    return flask.jsonify(job)
+
+
 @app.route("/portal/add", methods=["POST"])
 @authorise
 def portalsAdd():
-    global cached_xmltv
-    cached_xmltv = None
     id = uuid.uuid4().hex
     enabled = "true"
     name = request.form["name"]
@@ -291,69 +789,44 @@ def portalsAdd():
     epgOffset = request.form["epg offset"]
     proxy = request.form["proxy"]
 
-    if not url.endswith(".php"):
-        url = stb.getUrl(url, proxy)
-        if not url:
-            logger.error("Error getting URL for Portal({})".format(name))
-            flash("Error getting URL for Portal({})".format(name), "danger")
-            return redirect("/portals", code=302)
-
-    macsd = {}
+    def apply(url, macsd):
+        if len(macsd) > 0:
+            portal = {
+                "enabled": enabled,
+                "name": name,
+                "url": url,
+                "macs": macsd,
+                "streams per mac": streamsPerMac,
+                "epg offset": epgOffset,
+                "proxy": proxy,
+            }
+
+            for setting, default in defaultPortal.items():
+                if not portal.get(setting):
+                    portal[setting] = default
+
+            portals = getPortals()
+            portals[id] = portal
+            savePortals(portals)
+            invalidateCatalog(id)
+            refreshAll([id])
+            logger.info("Portal({}) added!".format(portal["name"]))
+            return "success", "Portal({}) added!".format(portal["name"])
 
-    for mac in macs:
-        token = stb.getToken(url, mac, proxy)
-        if token:
-            stb.getProfile(url, mac, token, proxy)
-            expiry = stb.getExpires(url, mac, token, proxy)
-            if expiry:
-                macsd[mac] = expiry
-                logger.info(
-                    "Successfully tested MAC({}) for Portal({})".format(mac, name)
-                )
-                flash(
-                    "Successfully tested MAC({}) for Portal({})".format(mac, name),
-                    "success",
-                )
-                continue
-
-        logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
-        flash("Error testing MAC({}) for Portal({})".format(mac, name), "danger")
-
-    if len(macsd) > 0:
-        portal = {
-            "enabled": enabled,
-            "name": name,
-            "url": url,
-            "macs": macsd,
-            "streams per mac": streamsPerMac,
-            "epg offset": epgOffset,
-            "proxy": proxy,
-        }
-
-        for setting, default in defaultPortal.items():
-            if not portal.get(setting):
-                portal[setting] = default
-
-        portals = getPortals()
-        portals[id] = portal
-        savePortals(portals)
-        logger.info("Portal({}) added!".format(portal["name"]))
-
-    else:
         logger.error(
             "None of the MACs tested OK for Portal({}). Adding not successfull".format(
                 name
             )
         )
+        return "danger", "None of the MACs tested OK for Portal({}). Adding not successfull".format(name)
 
-    return redirect("/portals", code=302)
+    job = startMacJob(name, url, proxy, macs, apply)
+    return redirect("/portals?job=" + job, code=302)
 
 
 @app.route("/portal/update", methods=["POST"])
 @authorise
 def portalUpdate():
-    global cached_xmltv
-    cached_xmltv = None
     id = request.form["id"]
     enabled = request.form.get("enabled", "false")
     name = request.form["name"]
@@ -364,64 +837,44 @@ def portalUpdate():
     proxy = request.form["proxy"]
     retest = request.form.get("retest", None)
 
-    if not url.endswith(".php"):
-        url = stb.getUrl(url, proxy)
-        if not url:
-            logger.error("Error getting URL for Portal({})".format(name))
-            flash("Error getting URL for Portal({})".format(name), "danger")
-            return redirect("/portals", code=302)
-
-    portals = getPortals()
-    oldmacs = portals[id]["macs"]
-    macsout = {}
-    deadmacs = []
-
-    for mac in newmacs:
-        if retest or mac not in oldmacs.keys():
-            token = stb.getToken(url, mac, proxy)
-            if token:
-                stb.getProfile(url, mac, token, proxy)
-                expiry = stb.getExpires(url, mac, token, proxy)
-                if expiry:
-                    macsout[mac] = expiry
-                    logger.info(
-                        "Successfully tested MAC({}) for Portal({})".format(mac, name)
-                    )
-                    flash(
-                        "Successfully tested MAC({}) for Portal({})".format(mac, name),
-                        "success",
-                    )
-
-            if mac not in list(macsout.keys()):
-                deadmacs.append(mac)
-
-        if mac in oldmacs.keys() and mac not in deadmacs:
-            macsout[mac] = oldmacs[mac]
+    oldmacs = getPortals()[id]["macs"]
+    testmacs = [mac for mac in newmacs if retest or mac not in oldmacs.keys()]
 
-        if mac not in macsout.keys():
-            logger.error("Error testing MAC({}) for Portal({})".format(mac, name))
-            flash("Error testing MAC({}) for Portal({})".format(mac, name), "danger")
-
-    if len(macsout) > 0:
-        portals[id]["enabled"] = enabled
-        portals[id]["name"] = name
-        portals[id]["url"] = url
-        portals[id]["macs"] = macsout
-        portals[id]["streams per mac"] = streamsPerMac
-        portals[id]["epg offset"] = epgOffset
-        portals[id]["proxy"] = proxy
-        savePortals(portals)
-        logger.info("Portal({}) updated!".format(name))
-        flash("Portal({}) updated!".format(name), "success")
+    def apply(url, tested):
+        portals = getPortals()
+        if id not in portals:
+            return "danger", "Portal({}) was removed while testing".format(name)
+        oldmacs = portals[id]["macs"]
+        macsout = {}
+        for mac in newmacs:
+            if mac in tested:
+                macsout[mac] = tested[mac]
+            elif mac in oldmacs.keys() and mac not in testmacs:
+                macsout[mac] = oldmacs[mac]
+
+        if len(macsout) > 0:
+            portals[id]["enabled"] = enabled
+            portals[id]["name"] = name
+            portals[id]["url"] = url
+            portals[id]["macs"] = macsout
+            portals[id]["streams per mac"] = streamsPerMac
+            portals[id]["epg offset"] = epgOffset
+            portals[id]["proxy"] = proxy
+            savePortals(portals)
+            invalidateCatalog(id)
+            refreshAll([id])
+            logger.info("Portal({}) updated!".format(name))
+            return "success", "Portal({}) updated!".format(name)
 
-    else:
         logger.error(
             "None of the MACs tested OK for Portal({}). Adding not successfull".format(
                 name
             )
         )
+        return "danger", "None of the MACs tested OK for Portal({}). Adding not successfull".format(name)
 
-    return redirect("/portals", code=302)
+    job = startMacJob(name, url, proxy, testmacs, apply)
+    return redirect("/portals?job=" + job, code=302)
 
 
 @app.route("/portal/remove", methods=["POST"])
@@ -432,6 +885,8 @@ def portalRemove():
     name = portals[id]["name"]
     del portals[id]
     savePortals(portals)
+    invalidateCatalog(id)
+    refreshAll([])  # Nothing to fetch, just leave the portal out
     logger.info("Portal ({}) removed!".format(name))
     flash("Portal ({}) removed!".format(name), "success")
     return redirect("/portals", code=302)
@@ -444,38 +899,57 @@ def editor():
     
 
 
-@app.route("/editor_data", methods=["GET"])
-@authorise
-def editor_data():
-    channels = []
+# Editor index #
+# The editor pages, filters and sorts on the server. Rows for every enabled
+# portal are built once per catalog or config change, together with a search
+# string and sort keys, and sorted orders and searches are remembered.
+
+
+editorIndex = None
+editorIndexLock = threading.Lock()
+editorSearches = 32  # Recent searches remembered per index
+
+
+def editorKeys(row):
+    name = row["customChannelName"] or row["channelName"]
+    genre = row["customGenre"] or row["genre"]
+    number = row["customChannelNumber"] or row["channelNumber"]
+    search = " ".join(
+        [name, genre, number, row["customEpgId"], row["fallbackChannel"], row["portalName"]]
+    ).lower()
+    try:
+        numberKey = (0, float(number), "")
+    except ValueError:
+        numberKey = (1, 0, number.lower())
+    sortKeys = {
+        2: name.lower(),
+        3: genre.lower(),
+        4: numberKey,
+        5: row["customEpgId"].lower(),
+        6: row["fallbackChannel"].lower(),
+        7: row["portalName"].lower(),
+    }
+    return search, sortKeys
+
+
+def buildEditorEntries():
+    entries = []
     portals = getPortals()
     for portal in portals:
-        logger.info(f"getting Data from {portal}")
         if portals[portal]["enabled"] == "true":
             portalName = portals[portal]["name"]
-            url = portals[portal]["url"]
-            macs = list(portals[portal]["macs"].keys())
-            proxy = portals[portal]["proxy"]
-            enabledChannels = portals[portal].get("enabled channels", [])
+            enabledChannels = set(portals[portal].get("enabled channels", []))
             customChannelNames = portals[portal].get("custom channel names", {})
             customGenres = portals[portal].get("custom genres", {})
             customChannelNumbers = portals[portal].get("custom channel numbers", {})
             customEpgIds = portals[portal].get("custom epg ids", {})
             fallbackChannels = portals[portal].get("fallback channels", {})
 
-            for mac in macs:
-                logger.info(f"Using mac: {mac}")
-                try:
-                    token = stb.getToken(url, mac, proxy)
-                    stb.getProfile(url, mac, token, proxy)
-                    allChannels = stb.getAllChannels(url, mac, token, proxy)
-                    genres = stb.getGenreNames(url, mac, token, proxy)
-                    break
-                except:
-                    allChannels = None
-                    genres = None
+            catalog = getCatalog(portal)
+            if catalog:
+                allChannels = catalog["channels"]
+                genres = catalog["genres"]
 
-            if allChannels and genres:
                 for channel in allChannels:
                     channelId = str(channel["id"])
                     channelName = str(channel["name"])
@@ -500,29 +974,28 @@ def editor_data():
                     fallbackChannel = fallbackChannels.get(channelId)
                     if fallbackChannel == None:
                         fallbackChannel = ""
-                    channels.append(
-                        {
-                            "portal": portal,
-                            "portalName": portalName,
-                            "enabled": enabled,
-                            "channelNumber": channelNumber,
-                            "customChannelNumber": customChannelNumber,
-                            "channelName": channelName,
-                            "customChannelName": customChannelName,
-                            "genre": genre,
-                            "customGenre": customGenre,
-                            "channelId": channelId,
-                            "customEpgId": customEpgId,
-                            "fallbackChannel": fallbackChannel,
-                            "link": "http://"
-                            + host
-                            + "/play/"
-                            + portal
-                            + "/"
-                            + channelId
-                            + "?web=true",
-                        }
-                    )
+                    row = {
+                        "portal": portal,
+                        "portalName": portalName,
+                        "enabled": enabled,
+                        "channelNumber": channelNumber,
+                        "customChannelNumber": customChannelNumber,
+                        "channelName": channelName,
+                        "customChannelName": customChannelName,
+                        "genre": genre,
+                        "customGenre": customGenre,
+                        "channelId": channelId,
+                        "customEpgId": customEpgId,
+                        "fallbackChannel": fallbackChannel,
+                        "link": "http://"
+                        + host
+                        + "/play/"
+                        + portal
+                        + "/"
+                        + channelId
+                        + "?web=true",
+                    }
+                    entries.append((row, *editorKeys(row)))
             else:
                 logger.error(
                     "Error getting channel data for {}, skipping".format(portalName)
@@ -532,19 +1005,112 @@ def editor_data():
                     "danger",
                 )
 
-    data = {"data": channels}
+    return entries
+
+
+def getEditorIndex():
+    global editorIndex
+    portals = getPortals()
+    version = [portalsVersion]
+    for portal in portals:
+        if portals[portal]["enabled"] == "true":
+            catalog = getCatalog(portal)
+            version.append((portal, catalog["updated"] if catalog else None))
+
+    with editorIndexLock:
+        if editorIndex is None or editorIndex["version"] != version:
+            editorIndex = {
+                "version": version,
+                "entries": buildEditorEntries(),
+                "orders": {},
+                "searches": OrderedDict(),
+            }
+        return editorIndex
+
+
+def getEditorOrder(index, column, descending):
+    key = (column, descending)
+    order = index["orders"].get(key)
+    if order is None:
+        entries = index["entries"]
+        order = sorted(range(len(entries)), key=lambda i: entries[i][2][column], reverse=descending)
+        # Enabled channels always come first
+        order.sort(key=lambda i: not entries[i][0]["enabled"])
+        index["orders"][key] = order
+    return order
+
+
+def searchEditor(index, column, descending, search):
+    key = (column, descending, search)
+    searches = index["searches"]
+    matches = searches.get(key)
+    if matches is not None:
+        searches.move_to_end(key)
+        return matches
+
+    # Typing more of a search only narrows the last one
+    candidates = getEditorOrder(index, column, descending)
+    for (c, d, previous), previousMatches in reversed(searches.items()):
+        if c == column and d == descending and search.startswith(previous):
+            candidates = previousMatches
+            break
+
+    entries = index["entries"]
+    terms = search.split()
+    matches = [i for i in candidates if all(term in entries[i][1] for term in terms)]
+    searches[key] = matches
+    while len(searches) > editorSearches:
+        searches.popitem(last=False)
+    return matches
+
+
+@app.route("/editor_data", methods=["GET"])
+@authorise
+def editor_data():
+    # DataTables server-side processing
+    draw = request.args.get("draw", 0, type=int)
+    start = max(0, request.args.get("start", 0, type=int))
+    length = request.args.get("length", 25, type=int)
+    search = request.args.get("search[value]", "").strip().lower()
+    column = request.args.get("order[0][column]", 4, type=int)
+    descending = request.args.get("order[0][dir]", "asc") == "desc"
+    if column not in range(2, 8):
+        column = 4  # Only the text columns can be sorted
+
+    index = getEditorIndex()
+    with editorIndexLock:
+        matches = searchEditor(index, column, descending, search)
+    entries = index["entries"]
+    page = matches[start:] if length < 0 else matches[start : start + length]
+
+    data = {
+        "draw": draw,
+        "recordsTotal": len(entries),
+        "recordsFiltered": len(matches),
+        "data": [entries[i][0] for i in page],
+    }
 
     return flask.jsonify(data)
 
 
+def applyCustomEdits(portals, edits, setting, field, touched):
+    for edit in edits:
+        portal = edit["portal"]
+        channelId = edit["channel id"]
+        value = edit[field]
+        customs = portals[portal].setdefault(setting, {})
+        if value:
+            if customs.get(channelId) != value:
+                customs[channelId] = value
+                touched.add(portal)
+        elif channelId in customs:
+            del customs[channelId]
+            touched.add(portal)
+
+
 @app.route("/editor/save", methods=["POST"])
 @authorise
 def editorSave():
-    global cached_xmltv
-    #cached_xmltv = None # The tv guide will be updated next time its downloaded
-    threading.Thread(target=refresh_xmltv, daemon=True).start() #Force update in a seperate thread
-    last_playlist_host = None     # The playlist will be updated next time it is downloaded
-    Thread(target=refresh_lineup).start() # Update the channel lineup for plex.
     enabledEdits = json.loads(request.form["enabledEdits"])
     numberEdits = json.loads(request.form["numberEdits"])
     nameEdits = json.loads(request.form["nameEdits"])
@@ -552,69 +1118,34 @@ def editorSave():
     epgEdits = json.loads(request.form["epgEdits"])
     fallbackEdits = json.loads(request.form["fallbackEdits"])
     portals = getPortals()
-    for edit in enabledEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        enabled = edit["enabled"]
-        if enabled:
-            portals[portal].setdefault("enabled channels", [])
-            portals[portal]["enabled channels"].append(channelId)
-        else:
-            portals[portal]["enabled channels"] = list(
-                filter((channelId).__ne__, portals[portal]["enabled channels"])
-            )
-
-    for edit in numberEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customNumber = edit["custom number"]
-        if customNumber:
-            portals[portal].setdefault("custom channel numbers", {})
-            portals[portal]["custom channel numbers"].update({channelId: customNumber})
-        else:
-            portals[portal]["custom channel numbers"].pop(channelId)
-
-    for edit in nameEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customName = edit["custom name"]
-        if customName:
-            portals[portal].setdefault("custom channel names", {})
-            portals[portal]["custom channel names"].update({channelId: customName})
-        else:
-            portals[portal]["custom channel names"].pop(channelId)
-
-    for edit in genreEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customGenre = edit["custom genre"]
-        if customGenre:
-            portals[portal].setdefault("custom genres", {})
-            portals[portal]["custom genres"].update({channelId: customGenre})
-        else:
-            portals[portal]["custom genres"].pop(channelId)
+    touched = set()
 
-    for edit in epgEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        customEpgId = edit["custom epg id"]
-        if customEpgId:
-            portals[portal].setdefault("custom epg ids", {})
-            portals[portal]["custom epg ids"].update({channelId: customEpgId})
-        else:
-            portals[portal]["custom epg ids"].pop(channelId)
-
-    for edit in fallbackEdits:
-        portal = edit["portal"]
-        channelId = edit["channel id"]
-        channelName = edit["channel name"]
-        if channelName:
-            portals[portal].setdefault("fallback channels", {})
-            portals[portal]["fallback channels"].update({channelId: channelName})
-        else:
-            portals[portal]["fallback channels"].pop(channelId)
-
-    savePortals(portals)
+    # Only the last edit of each channel counts
+    enabledChanges = {}
+    for edit in enabledEdits:
+        enabledChanges.setdefault(edit["portal"], {})[edit["channel id"]] = edit["enabled"]
+
+    for portal, changes in enabledChanges.items():
+        current = portals[portal].get("enabled channels", [])
+        currentSet = set(current)
+        enable = [c for c, enabled in changes.items() if enabled and c not in currentSet]
+        disable = {c for c, enabled in changes.items() if not enabled and c in currentSet}
+        if enable or disable:
+            portals[portal]["enabled channels"] = [
+                c for c in current if c not in disable
+            ] + enable
+            touched.add(portal)
+
+    applyCustomEdits(portals, numberEdits, "custom channel numbers", "custom number", touched)
+    applyCustomEdits(portals, nameEdits, "custom channel names", "custom name", touched)
+    applyCustomEdits(portals, genreEdits, "custom genres", "custom genre", touched)
+    applyCustomEdits(portals, epgEdits, "custom epg ids", "custom epg id", touched)
+    applyCustomEdits(portals, fallbackEdits, "fallback channels", "channel name", touched)
+
+    if touched:
+        savePortals(portals)
+        # Only rebuild the guide, playlist and lineup of the edited portals
+        refreshAll(touched)
     logger.info("Playlist config saved!")
     flash("Playlist config saved!", "success")
     return redirect("/editor", code=302)
@@ -633,6 +1164,7 @@ def editorReset():
         portals[portal]["fallback channels"] = {}
 
     savePortals(portals)
+    refreshAll()
     logger.info("Playlist reset!")
     flash("Playlist reset!", "success")
     return redirect("/editor", code=302)
@@ -658,7 +1190,8 @@ def save():
 
     saveSettings(settings)
     logger.info("Settings saved!")
-    Thread(target=refresh_xmltv).start()
+    applyPoolSize()
+    refreshAll()
     flash("Settings saved!", "success")
     return redirect("/settings", code=302)
 
@@ -666,125 +1199,412 @@ def save():
 @app.route("/playlist.m3u", methods=["GET"])
 @authorise
 def playlist():
-    global cached_playlist, last_playlist_host
-    
     logger.info("Playlist Requested")
-    
-    # Detect the current host dynamically
-    current_host = request.host or "127.0.0.1"
-    
-    # Regenerate the playlist if it is empty or the host has changed
-    if cached_playlist is None or len(cached_playlist) == 0 or last_playlist_host != current_host:
-        logger.info(f"Regenerating playlist due to host change: {last_playlist_host} -> {current_host}")
-        last_playlist_host = current_host
-        generate_playlist()
 
-    return Response(cached_playlist, mimetype="text/plain")
+    # Only wait if the playlist has never been built
+    if compiled_playlist is None:
+        triggerRefresh("playlist").wait()
+    if compiled_playlist is None:
+        return make_response("Playlist not available", 503)
+
+    # Detect the current host dynamically
+    return cachedResponse(renderPlaylist(request.host or "127.0.0.1"))
 
 # Function to manually trigger playlist update
 @app.route("/update_playlistm3u", methods=["POST"])
 def update_playlistm3u():
-    generate_playlist()
+    triggerRefresh("playlist").wait()
     return Response("Playlist updated successfully", status=200)
 
-def generate_playlist():
-    global cached_playlist
-    logger.info("Generating playlist.m3u...")
-
-    # Detect the host dynamically from the request
-    playlist_host = request.host or "127.0.0.1"
-    
-    channels = []
+def buildPlaylistPortal(portal):
     portals = getPortals()
-
-    for portal in portals:
-        if portals[portal]["enabled"] == "true":
-            enabledChannels = portals[portal].get("enabled channels", [])
-            if len(enabledChannels) != 0:
-                name = portals[portal]["name"]
-                url = portals[portal]["url"]
-                macs = list(portals[portal]["macs"].keys())
-                proxy = portals[portal]["proxy"]
-                customChannelNames = portals[portal].get("custom channel names", {})
-                customGenres = portals[portal].get("custom genres", {})
-                customChannelNumbers = portals[portal].get("custom channel numbers", {})
-                customEpgIds = portals[portal].get("custom epg ids", {})
-
-                for mac in macs:
-                    try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
-                        genres = stb.getGenreNames(url, mac, token, proxy)
-                        break
-                    except:
-                        allChannels = None
-                        genres = None
-
-                if allChannels and genres:
-                    for channel in allChannels:
-                        channelId = str(channel.get("id"))
-                        if channelId in enabledChannels:
-                            channelName = customChannelNames.get(channelId)
-                            if channelName is None:
-                                channelName = str(channel.get("name"))
-                            genre = customGenres.get(channelId)
-                            if genre is None:
-                                genreId = str(channel.get("tv_genre_id"))
-                                genre = str(genres.get(genreId))
-                            channelNumber = customChannelNumbers.get(channelId)
-                            if channelNumber is None:
-                                channelNumber = str(channel.get("number"))
-                            epgId = customEpgIds.get(channelId)
-                            if epgId is None:
-                                epgId = channelName
-                            channels.append(
-                                "#EXTINF:-1"
-                                + ' tvg-id="'
-                                + epgId
-                                + (
-                                    '" tvg-chno="' + channelNumber
-                                    if getSettings().get("use channel numbers", "true")
-                                    == "true"
-                                    else ""
-                                )
-                                + (
-                                    '" group-title="' + genre
-                                    if getSettings().get("use channel genres", "true")
-                                    == "true"
-                                    else ""
-                                )
-                                + '",'
-                                + channelName
-                                + "\n"
-                                + "http://"
-                                + playlist_host  # Use the dynamically detected playlist host
-                                + "/play/"
-                                + portal
-                                + "/"
-                                + channelId
+    channels = []
+    enabledChannels = portals[portal].get("enabled channels", [])
+    if len(enabledChannels) != 0:
+        name = portals[portal]["name"]
+        customChannelNames = portals[portal].get("custom channel names", {})
+        customGenres = portals[portal].get("custom genres", {})
+        customChannelNumbers = portals[portal].get("custom channel numbers", {})
+        customEpgIds = portals[portal].get("custom epg ids", {})
+
+        catalog = getCatalog(portal)
+        if catalog:
+            allChannels = catalog["channels"]
+            genres = catalog["genres"]
+
+            for channel in allChannels:
+                channelId = str(channel.get("id"))
+                if channelId in enabledChannels:
+                    channelName = customChannelNames.get(channelId)
+                    if channelName is None:
+                        channelName = str(channel.get("name"))
+                    genre = customGenres.get(channelId)
+                    if genre is None:
+                        genreId = str(channel.get("tv_genre_id"))
+                        genre = str(genres.get(genreId))
+                    channelNumber = customChannelNumbers.get(channelId)
+                    if channelNumber is None:
+                        channelNumber = str(channel.get("number"))
+                    epgId = customEpgIds.get(channelId)
+                    if epgId is None:
+                        epgId = channelName
+                    # The host is added when the playlist is rendered
+                    channels.append(
+                        (
+                            "#EXTINF:-1"
+                            + ' tvg-id="'
+                            + epgId
+                            + (
+                                '" tvg-chno="' + channelNumber
+                                if getSettings().get("use channel numbers", "true")
+                                == "true"
+                                else ""
                             )
-                else:
-                    logger.error("Error making playlist for {}, skipping".format(name))
+                            + (
+                                '" group-title="' + genre
+                                if getSettings().get("use channel genres", "true")
+                                == "true"
+                                else ""
+                            )
+                            + '",'
+                            + channelName,
+                            "/play/" + portal + "/" + channelId,
+                        )
+                    )
+        else:
+            logger.error("Error making playlist for {}, skipping".format(name))
+
+    return channels
+
+
+def generate_playlist(portalIds=None):
+    global compiled_playlist
+    logger.info("Generating playlist.m3u...")
+
+    # Fetch the portals' channels at once
+    parts, results = updateParts("playlist", buildPlaylistPortal, portalIds)
+    channels = [channel for part in parts for channel in part]
 
     # Sorting the playlist based on settings
     if getSettings().get("sort playlist by channel name", "true") == "true":
-        channels.sort(key=lambda k: k.split(",")[1].split("\n")[0])
+        channels.sort(key=lambda k: k[0].split(",")[1])
     if getSettings().get("use channel numbers", "true") == "true":
         if getSettings().get("sort playlist by channel number", "false") == "true":
-            channels.sort(key=lambda k: k.split('tvg-chno="')[1].split('"')[0])
+            channels.sort(key=lambda k: k[0].split('tvg-chno="')[1].split('"')[0])
     if getSettings().get("use channel genres", "true") == "true":
         if getSettings().get("sort playlist by channel genre", "false") == "true":
-            channels.sort(key=lambda k: k.split('group-title="')[1].split('"')[0])
+            channels.sort(key=lambda k: k[0].split('group-title="')[1].split('"')[0])
+
+    # Keep the text around every host as it is, so a host is a single join
+    parts = []
+    text = "#EXTM3U \n"
+    for extinf, path in channels:
+        parts.append(text + extinf + "\nhttp://")
+        text = path + "\n"
+    parts.append(text[:-1] if channels else text)
+
+    with playlistLock:
+        compiled_playlist = parts
+        playlistCaches.clear()
+    logger.info("Playlist generated and cached.")
 
-    playlist = "#EXTM3U \n"
-    playlist = playlist + "\n".join(channels)
 
-    # Update the cache
-    cached_playlist = playlist
-    logger.info("Playlist generated and cached.")
+def renderPlaylist(playlist_host):
+    with playlistLock:
+        parts = compiled_playlist
+        cache = playlistCaches.get(playlist_host)
+        if cache is not None:
+            playlistCaches.move_to_end(playlist_host)
+            return cache
+
+    cache = makeCache(playlist_host.join(parts).encode("utf-8"), "text/plain")
+
+    with playlistLock:
+        # Only keep it if the playlist was not rebuilt while rendering
+        if parts is compiled_playlist:
+            playlistCaches[playlist_host] = cache
+            while len(playlistCaches) > playlistCacheHosts:
+                playlistCaches.popitem(last=False)
+    return cache
     
-def refresh_xmltv():
+# XMLTV writer #
+# Channels and programmes are written one at a time, so building the guide
+# never holds more than the records themselves in memory.
+
+
+xmltvIndent = "  "  # Use "" for a compact guide
+invalidXmlChars = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def xmlText(value):
+    return escape(invalidXmlChars.sub("", str(value))) if value is not None else ""
+
+
+def xmlAttr(value):
+    return quoteattr(invalidXmlChars.sub("", str(value)) if value is not None else "")
+
+
+def xmltvTime(timestamp):
+    return time.strftime("%Y%m%d%H%M%S", time.gmtime(timestamp)) + " +0000"
+
+
+def writeXmltv(f, channels, programmes, indent="  "):
+    newline = "\n" if indent else ""
+    inner = indent * 2
+    f.write('<?xml version="1.0" encoding="UTF-8"?>' + newline)
+    f.write("<tv>" + newline)
+    for epgId, name, logo in channels:
+        f.write(
+            indent + "<channel id=" + xmlAttr(epgId) + ">" + newline
+            + inner + "<display-name>" + xmlText(name) + "</display-name>" + newline
+            + inner + "<icon src=" + xmlAttr(logo) + "/>" + newline
+            + indent + "</channel>" + newline
+        )
+    for epgId, start, stop, title, desc in programmes:
+        f.write(
+            indent + "<programme start=" + xmlAttr(xmltvTime(start)) + " stop=" + xmlAttr(xmltvTime(stop)) + " channel=" + xmlAttr(epgId) + ">" + newline
+            + inner + "<title>" + xmlText(title) + "</title>" + newline
+            + inner + "<desc>" + xmlText(desc) + "</desc>" + newline
+            + indent + "</programme>" + newline
+        )
+    f.write("</tv>" + newline)
+
+
+def replaceFile(source, destination):
+    # Windows refuses to replace a file another thread is still reading
+    for attempt in range(30):
+        try:
+            os.replace(source, destination)
+            return
+        except PermissionError:
+            time.sleep(1)
+    os.replace(source, destination)
+
+
+# Cached responses #
+# The guide, playlist and lineup are compressed once per refresh and served
+# with strong ETags so unchanged polls get a 304.
+
+
+def makeCache(body, mimetype):
+    return {
+        "body": body,
+        "gzip": gzip.compress(body),
+        "etag": hashlib.sha1(body).hexdigest(),
+        "modified": time.time(),
+        "mimetype": mimetype,
+    }
+
+
+def makeFileCache(path, mimetype):
+    digest = hashlib.sha1()
+    gzipPath = path + ".gz"
+    temp_file = "{}.{}.tmp".format(gzipPath, threading.get_ident())
+    with open(path, "rb") as source, gzip.open(temp_file, "wb") as target:
+        while True:
+            chunk = source.read(65536)
+            if not chunk:
+                break
+            digest.update(chunk)
+            target.write(chunk)
+    replaceFile(temp_file, gzipPath)
+    return {
+        "path": path,
+        "gzipPath": gzipPath,
+        "etag": digest.hexdigest(),
+        "modified": time.time(),
+        "mimetype": mimetype,
+    }
+
+
+def cachedResponse(cache):
+    gzipped = "gzip" in request.accept_encodings
+    if "path" in cache:
+        body = streamFile(cache["gzipPath"] if gzipped else cache["path"])
+    else:
+        body = cache["gzip"] if gzipped else cache["body"]
+
+    response = Response(body, mimetype=cache["mimetype"])
+    if gzipped:
+        response.content_encoding = "gzip"
+    response.vary.add("Accept-Encoding")
+    # Each encoding is its own representation, so it gets its own ETag
+    response.set_etag(cache["etag"] + ("-gzip" if gzipped else ""))
+    response.last_modified = datetime.fromtimestamp(cache["modified"], timezone.utc)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def streamFile(path, chunkSize=65536):
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                break
+            yield chunk
+
+
+# EPG store #
+# Programmes live in a SQLite database keyed by channel and start time, so a
+# refresh only writes what the portals sent and deletes what has expired.
+
+
+epgFile = os.path.join(log_dir, "MacReplayEPG.db")
+epgLock = threading.Lock()
+
+
+def openEpgStore():
+    db = sqlite3.connect(epgFile, timeout=30)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS programmes ("
+        "channel TEXT NOT NULL, start INTEGER NOT NULL, stop INTEGER NOT NULL, "
+        "title TEXT, desc TEXT, PRIMARY KEY (channel, start))"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS programmes_stop ON programmes (stop)")
+    return db
+
+
+def storeProgrammes(db, programmes):
+    db.executemany(
+        "INSERT OR REPLACE INTO programmes (channel, start, stop, title, desc) VALUES (?, ?, ?, ?, ?)",
+        programmes,
+    )
+
+
+def mergeProgrammes(db, programmes):
+    # Last writer wins per (channel, start). Within the batch, and against
+    # the store, an older programme that overlaps a newer one is cut short at
+    # the newer start, or dropped when nothing of it is left.
+    latest = {}
+    for programme in programmes:
+        latest[(programme[0], programme[1])] = programme
+
+    merged = []
+    for programme in sorted(latest.values(), key=lambda p: (p[0], p[1])):
+        if merged and merged[-1][0] == programme[0] and merged[-1][2] > programme[1]:
+            previous = merged.pop()
+            if programme[1] > previous[1]:
+                merged.append(previous[:2] + (programme[1],) + previous[3:])
+        merged.append(programme)
+
+    db.executemany(
+        "DELETE FROM programmes WHERE channel = ? AND start > ? AND start < ?",
+        [(channel, start, stop) for channel, start, stop, _, _ in merged],
+    )
+    db.executemany(
+        "UPDATE programmes SET stop = ? WHERE channel = ? AND start < ? AND stop > ?",
+        [(start, channel, start, start) for channel, start, _, _, _ in merged],
+    )
+    storeProgrammes(db, merged)
+
+
+def pruneProgrammes(db, cutoff):
+    db.execute("DELETE FROM programmes WHERE stop < ?", (cutoff,))
+
+
+def queryProgrammes(db, channelIds, since):
+    for channelId in channelIds:
+        yield from db.execute(
+            "SELECT channel, start, stop, title, desc FROM programmes "
+            "WHERE channel = ? AND stop >= ? ORDER BY start",
+            (channelId, since),
+        )
+
+
+def importXmltvCache(db, cache_file):
+    # Carry the guide over from versions that kept it only in MacReplayEPG.xml
+    if db.execute("SELECT 1 FROM programmes LIMIT 1").fetchone() or not os.path.exists(cache_file):
+        return
+    programmes = []
+    try:
+        for _, programme in ET.iterparse(cache_file):
+            if programme.tag == "programme":
+                start = datetime.strptime(programme.get("start").split(" ")[0], "%Y%m%d%H%M%S")
+                stop = datetime.strptime(programme.get("stop").split(" ")[0], "%Y%m%d%H%M%S")
+                programmes.append(
+                    (
+                        programme.get("channel"),
+                        int(start.replace(tzinfo=timezone.utc).timestamp()),
+                        int(stop.replace(tzinfo=timezone.utc).timestamp()),
+                        programme.findtext("title", ""),
+                        programme.findtext("desc", ""),
+                    )
+                )
+                programme.clear()
+    except Exception as e:
+        logger.error(f"Failed to import cache file: {e}")
+    storeProgrammes(db, programmes)
+    logger.info("Imported {} programmes from the XMLTV cache.".format(len(programmes)))
+
+
+def buildXmltvPortal(portal, cutoff):
+    portals = getPortals()
+    channels = []
+    programmes = []
+    portal_name = portals[portal]["name"]
+    portal_epg_offset = int(portals[portal]["epg offset"])
+    logger.info(f"Fetching EPG | Portal: {portal_name} | offset: {portal_epg_offset} |")
+
+    enabledChannels = portals[portal].get("enabled channels", [])
+    if len(enabledChannels) != 0:
+        name = portals[portal]["name"]
+        url = portals[portal]["url"]
+        macs = list(portals[portal]["macs"].keys())
+        proxy = portals[portal]["proxy"]
+        customChannelNames = portals[portal].get("custom channel names", {})
+        customEpgIds = portals[portal].get("custom epg ids", {})
+        customChannelNumbers = portals[portal].get("custom channel numbers", {})
+
+        catalog = getCatalog(portal)
+        allChannels = catalog["channels"] if catalog else None
+        epg = None
+
+        for mac in macs:
+            try:
+                epg = stb.withToken(stb.getEpg, url, mac, 24, proxy=proxy)
+            except Exception as e:
+                epg = None
+                logger.error(f"Error fetching data for MAC {mac}: {e}")
+            if epg:
+                break
+
+        if allChannels and epg:
+            for channel in allChannels:
+                try:
+                    channelId = str(channel.get("id"))
+                    if str(channelId) in enabledChannels:
+                        channelName = customChannelNames.get(channelId, channel.get("name"))
+                        channelNumber = customChannelNumbers.get(channelId, str(channel.get("number")))
+                        epgId = customEpgIds.get(channelId, channelNumber)
+
+                        channels.append((epgId, channelName, channel.get("logo")))
+
+                        if channelId not in epg or not epg.get(channelId):
+                            logger.warning(f"No EPG data found for channel {channelName} (ID: {channelId}), Creating a Dummy EPG item.")
+                            start = int(time.time()) // 3600 * 3600
+                            stop = start + 24 * 3600
+                            programmes.append((epgId, start, stop, channelName, channelName))
+                        else:
+                            for p in epg.get(channelId):
+                                try:
+                                    start = int(p.get("start_timestamp")) + portal_epg_offset * 3600
+                                    stop = int(p.get("stop_timestamp")) + portal_epg_offset * 3600
+                                    if start <= cutoff:
+                                        continue
+                                    programmes.append((epgId, start, stop, p.get("name") or "", p.get("descr") or ""))
+                                except Exception as e:
+                                    logger.error(f"Error processing programme for channel {channelName} (ID: {channelId}): {e}")
+                                    pass
+                except Exception as e:
+                    logger.error(f"| Channel:{channelNumber} | {channelName} | {e}")
+                    pass
+        else:
+            logger.error(f"Error making XMLTV for {name}, skipping")
+
+    return channels, programmes
+
+
+def refresh_xmltv(portalIds=None):
     settings = getSettings()
     logger.info("Refreshing XMLTV...")
 
@@ -794,343 +1614,880 @@ def refresh_xmltv():
     os.makedirs(cache_dir, exist_ok=True)
     cache_file = os.path.join(cache_dir, "MacReplayEPG.xml")
 
-    # Define date cutoff for programme filtering
-    day_before_yesterday = datetime.utcnow() - timedelta(days=2)
-    day_before_yesterday_str = day_before_yesterday.strftime("%Y%m%d%H%M%S") + " +0000"
+    # Programmes that finished before this are dropped from the guide
+    cutoff = int(time.time()) - 2 * 24 * 3600
 
-    # Load existing cache if it exists
-    cached_programmes = []
-    if os.path.exists(cache_file):
+    # Fetch the portals' EPG at once, the other portals keep their channels
+    # and their programmes are already in the store
+    parts, results = updateParts(
+        "xmltv", buildXmltvPortal, portalIds, cutoff, keep=lambda result: result[0]
+    )
+    channels = [channel for part in parts for channel in part]
+    programmes = [
+        programme for result in results.values() for programme in result[1]
+    ]
+
+    # Merge the new programmes into the store and drop expired ones
+    with epgLock:
+        db = openEpgStore()
         try:
-            tree = ET.parse(cache_file)
-            root = tree.getroot()
-            for programme in root.findall("programme"):
-                stop_attr = programme.get("stop")  # Get the 'stop' attribute
-                if stop_attr:
-                    try:
-                        # Parse the stop time and compare with the cutoff
-                        stop_time = datetime.strptime(stop_attr.split(" ")[0], "%Y%m%d%H%M%S")
-                        if stop_time >= day_before_yesterday:  # Keep only recent programmes
-                            cached_programmes.append(ET.tostring(programme, encoding="unicode"))
-                    except ValueError as e:
-                        logger.warning(f"Invalid stop time format in cached programme: {stop_attr}. Skipping.")
-            logger.info("Loaded existing programme data from cache.")
-        except Exception as e:
-            logger.error(f"Failed to load cache file: {e}")
-
-    # Initialize new XMLTV data
-    channels = ET.Element("tv")
-    programmes = ET.Element("tv")
-    portals = getPortals()
+            importXmltvCache(db, cache_file)
+            mergeProgrammes(db, programmes)
+            pruneProgrammes(db, cutoff)
+            db.commit()
+        finally:
+            db.close()
 
-    for portal in portals:
-        if portals[portal]["enabled"] == "true":
-            portal_name = portals[portal]["name"]
-            portal_epg_offset = int(portals[portal]["epg offset"])
-            logger.info(f"Fetching EPG | Portal: {portal_name} | offset: {portal_epg_offset} |")
-
-            enabledChannels = portals[portal].get("enabled channels", [])
-            if len(enabledChannels) != 0:
-                name = portals[portal]["name"]
-                url = portals[portal]["url"]
-                macs = list(portals[portal]["macs"].keys())
-                proxy = portals[portal]["proxy"]
-                customChannelNames = portals[portal].get("custom channel names", {})
-                customEpgIds = portals[portal].get("custom epg ids", {})
-                customChannelNumbers = portals[portal].get("custom channel numbers", {})
-
-                for mac in macs:
-                    try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
-                        epg = stb.getEpg(url, mac, token, 24, proxy)
-                        break
-                    except Exception as e:
-                        allChannels = None
-                        epg = None
-                        logger.error(f"Error fetching data for MAC {mac}: {e}")
-
-                if allChannels and epg:
-                    for channel in allChannels:
-                        try:
-                            channelId = str(channel.get("id"))
-                            if str(channelId) in enabledChannels:
-                                channelName = customChannelNames.get(channelId, channel.get("name"))
-                                channelNumber = customChannelNumbers.get(channelId, str(channel.get("number")))
-                                epgId = customEpgIds.get(channelId, channelNumber)
-
-                                channelEle = ET.SubElement(
-                                    channels, "channel", id=epgId
-                                )
-                                ET.SubElement(channelEle, "display-name").text = channelName
-                                ET.SubElement(channelEle, "icon", src=channel.get("logo"))
-
-                                if channelId not in epg or not epg.get(channelId):
-                                    logger.warning(f"No EPG data found for channel {channelName} (ID: {channelId}), Creating a Dummy EPG item.")
-                                    start_time = datetime.utcnow().replace(minute=0, second=0, microsecond=0)
-                                    stop_time = start_time + timedelta(hours=24)
-                                    start = start_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                    stop = stop_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                    programmeEle = ET.SubElement(
-                                        programmes,
-                                        "programme",
-                                        start=start,
-                                        stop=stop,
-                                        channel=epgId,
-                                    )
-                                    ET.SubElement(programmeEle, "title").text = channelName
-                                    ET.SubElement(programmeEle, "desc").text = channelName
-                                else:
-                                    for p in epg.get(channelId):
-                                        try:
-                                            start_time = datetime.utcfromtimestamp(p.get("start_timestamp")) + timedelta(hours=portal_epg_offset)
-                                            stop_time = datetime.utcfromtimestamp(p.get("stop_timestamp")) + timedelta(hours=portal_epg_offset)
-                                            start = start_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                            stop = stop_time.strftime("%Y%m%d%H%M%S") + " +0000"
-                                            if start <= day_before_yesterday_str:
-                                                continue
-                                            programmeEle = ET.SubElement(
-                                                programmes,
-                                                "programme",
-                                                start=start,
-                                                stop=stop,
-                                                channel=epgId,
-                                            )
-                                            ET.SubElement(programmeEle, "title").text = p.get("name")
-                                            ET.SubElement(programmeEle, "desc").text = p.get("descr")
-                                        except Exception as e:
-                                            logger.error(f"Error processing programme for channel {channelName} (ID: {channelId}): {e}")
-                                            pass
-                        except Exception as e:
-                            logger.error(f"| Channel:{channelNumber} | {channelName} | {e}")
-                            pass
-                else:
-                    logger.error(f"Error making XMLTV for {name}, skipping")
-
-    # Combine channels and programmes into a single XML document
-    xmltv = channels
-    for programme in programmes.iter("programme"):
-        xmltv.append(programme)
-
-    # Add cached programmes, ensuring no duplicates
-    existing_programme_hashes = {ET.tostring(p, encoding="unicode") for p in xmltv.findall("programme")}
-    for cached in cached_programmes:
-        if cached not in existing_programme_hashes:
-            xmltv.append(ET.fromstring(cached))
-
-    # Pretty-print the XML with blank line removal
-    rough_string = ET.tostring(xmltv, encoding="unicode")
-    reparsed = minidom.parseString(rough_string)
-    formatted_xmltv = "\n".join([line for line in reparsed.toprettyxml(indent="  ").splitlines() if line.strip()])
-
-    # Save updated cache
-    with open(cache_file, "w", encoding="utf-8") as f:
-        f.write(formatted_xmltv)
+    # Write the guide straight to disk, then swap it in
+    temp_file = "{}.{}.tmp".format(cache_file, threading.get_ident())
+    channelIds = list(dict.fromkeys(channel[0] for channel in channels))
+    db = openEpgStore()
+    try:
+        with open(temp_file, "w", encoding="utf-8") as f:
+            writeXmltv(f, channels, queryProgrammes(db, channelIds, cutoff), xmltvIndent)
+    finally:
+        db.close()
+    replaceFile(temp_file, cache_file)
     logger.info("XMLTV cache updated.")
 
     # Update global cache
-    global cached_xmltv, last_updated
-    cached_xmltv = formatted_xmltv
-    last_updated = time.time()
-    logger.debug(f"Generated XMLTV: {formatted_xmltv}")
-    
+    global cached_xmltv
+    cached_xmltv = makeFileCache(cache_file, "text/xml")
+
+
 # Endpoint to get the XMLTV data
 @app.route("/xmltv", methods=["GET"])
 @authorise
 def xmltv():
-    global cached_xmltv, last_updated
     logger.info("Guide Requested")
     
-    # Check if the cached XMLTV data is older than 15 minutes
-    if cached_xmltv is None or (time.time() - last_updated) > 900:  # 900 seconds = 15 minutes
-        refresh_xmltv()
-    
-    return Response(
-        cached_xmltv,
-        mimetype="text/xml",
-    )
+    # Serve the last guide we built, only wait if there has never been one
+    if cached_xmltv is None:
+        triggerRefresh("xmltv").wait()
+    if cached_xmltv is None:
+        return make_response("Guide not available", 503)
 
+    return cachedResponse(cached_xmltv)
+
+
+# Shared upstreams #
+# The first viewer of a channel starts one ffmpeg on one MAC. Later viewers
+# of the same channel read from that upstream's buffer instead of tuning again.
+# When the last viewer leaves the upstream lingers for a while, so a client
+# that reconnects straight away does not have to tune again. Browser previews
+# (fragmented MP4) are never shared, a late viewer would miss the init segment.
+
+
+upstreams = {}
+upstreamsLock = threading.Lock()
+upstreamBufferChunks = 128  # Chunks kept in memory for viewers that fall behind
+passthroughRetries = 3  # Reconnects in a row before a passthrough stream gives up
+tsPacketSize = 188
+
+
+def getChunkSize():
+    try:
+        size = int(getSettings().get("stream chunk size", "65424"))
+    except ValueError:
+        size = 65424
+    # Only ever hand out whole MPEG-TS packets
+    return max(tsPacketSize, size - size % tsPacketSize)
 
-@app.route("/play/<portalId>/<channelId>", methods=["GET"])
-def channel(portalId, channelId):
-    def streamData():
-        def occupy():
-            occupied.setdefault(portalId, [])
-            occupied.get(portalId, []).append(
-                {
-                    "mac": mac,
-                    "channel id": channelId,
-                    "channel name": channelName,
-                    "client": ip,
-                    "portal name": portalName,
-                    "start time": startTime,
-                }
-            )
-            logger.info("Occupied Portal({}):MAC({})".format(portalId, mac))
-
-        def unoccupy():
-            occupied.get(portalId, []).remove(
-                {
-                    "mac": mac,
-                    "channel id": channelId,
-                    "channel name": channelName,
-                    "client": ip,
-                    "portal name": portalName,
-                    "start time": startTime,
-                }
-            )
-            logger.info("Unoccupied Portal({}):MAC({})".format(portalId, mac))
 
+def getLinger():
+    settings = getSettings()
+    try:
+        linger = max(0, int(settings.get("linger time", "10")))
+    except ValueError:
+        linger = 0
+    try:
+        warm = max(0, int(settings.get("warm channels", "0")))
+    except ValueError:
+        warm = 0
+    return linger, warm
+
+
+def reapUpstreams():
+    # Stop idle upstreams past their linger time, except the newest warm ones
+    linger, warm = getLinger()
+    now = time.time()
+    with upstreamsLock:
+        idle = [(u.idleSince, u) for u in upstreams.values() if u.idleSince is not None]
+    idle.sort(key=lambda i: i[0], reverse=True)
+    for index, (idleSince, upstream) in enumerate(idle):
+        if index >= warm and now - idleSince >= linger:
+            upstream.stop(idleSince)
+
+
+def releaseIdleUpstream(portalId):
+    # Free a MAC held by an idle upstream, oldest first
+    with upstreamsLock:
+        idle = [
+            (u.idleSince, u)
+            for u in upstreams.values()
+            if u.portalId == portalId and u.idleSince is not None
+        ]
+    for idleSince, upstream in sorted(idle, key=lambda i: i[0]):
+        if upstream.stop(idleSince):
+            logger.info("Released idle stream of Portal({}):MAC({})".format(upstream.portalName, upstream.mac))
+            return True
+    return False
+
+
+def relay(readinto, chunkSize, prefix=b""):
+    # Reads into one preallocated buffer and yields whole packets as soon as
+    # they arrive. A partial packet is carried over to the next read.
+    # readinto must return whatever has arrived, chunkSize is only a cap.
+    buffer = bytearray(chunkSize)
+    view = memoryview(buffer)
+    filled = len(prefix)
+    view[:filled] = prefix
+    while True:
+        n = readinto(view[filled:])
+        if not n:
+            if filled:
+                yield bytes(view[:filled])
+            return
+        filled += n
+        usable = filled - filled % tsPacketSize
+        if usable:
+            yield bytes(view[:usable])
+            remainder = filled - usable
+            view[:remainder] = view[usable:filled]
+            filled = remainder
+
+
+class Upstream:
+    def __init__(self, key, ffmpegcmd, portalId, portalName, mac, channelId, channelName, shared=True):
+        self.key = key
+        self.shared = shared
+        self.ffmpegcmd = ffmpegcmd
+        self.portalId = portalId
+        self.portalName = portalName
+        self.mac = mac
+        self.ring = [None] * upstreamBufferChunks
+        self.sequence = 0
+        self.clients = []
+        self.closed = False
+        self.process = None
+        self.streamId = None
+        self.idleSince = None
+        self.condition = threading.Condition()
+        self.stream = {
+            "mac": mac,
+            "channel id": channelId,
+            "channel name": channelName,
+            "client": "",
+            "portal name": portalName,
+            "start time": datetime.now(timezone.utc).timestamp(),
+            "bytes": 0,
+            "bitrate": 0,
+        }
+
+    def start(self):
+        # If the open fails the caller still holds the MAC's reservation
+        if not self.open():
+            self.stop()
+            return False
+        self.streamId = occupy(self.portalId, self.stream)
+        Thread(target=self.pump, daemon=True).start()
+        return True
+
+    def open(self):
         try:
-            startTime = datetime.now(timezone.utc).timestamp()
-            occupy()
-            with subprocess.Popen(
-                ffmpegcmd,
+            self.process = subprocess.Popen(
+                self.ffmpegcmd,
+                bufsize=0,
                 stdin=subprocess.DEVNULL,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.DEVNULL,
-            ) as ffmpeg_sp:
-                while True:
-                    chunk = ffmpeg_sp.stdout.read(1024)
-                    if len(chunk) == 0:
-                        if ffmpeg_sp.poll() != 0:
-                            logger.info("Ffmpeg closed with error({}). Moving MAC({}) for Portal({})".format(str(ffmpeg_sp.poll()), mac, portalName))
-                            moveMac(portalId, mac)
-                        break
-                    yield chunk
-        except:
-            pass
+            )
+        except Exception as e:
+            logger.error("Unable to start ffmpeg: {}".format(e))
+            return False
+        return True
+
+    def chunks(self):
+        yield from relay(self.process.stdout.readinto, getChunkSize())
+        returncode = self.process.wait()
+        if returncode != 0 and not self.closed:
+            logger.info("Ffmpeg closed with error({}) for Portal({}):MAC({})".format(str(returncode), self.portalName, self.mac))
+            macFailed(self.portalId, self.mac)
+
+    def kill(self):
+        if self.process:
+            self.process.kill()
+
+    def pump(self):
+        windowStart = time.time()
+        windowBytes = 0
+        try:
+            for chunk in self.chunks():
+                with self.condition:
+                    self.ring[self.sequence % upstreamBufferChunks] = chunk
+                    self.sequence += 1
+                    self.condition.notify_all()
+
+                self.stream["bytes"] += len(chunk)
+                windowBytes += len(chunk)
+                elapsed = time.time() - windowStart
+                if elapsed >= 1:
+                    self.stream["bitrate"] = int(windowBytes * 8 / elapsed / 1000)
+                    windowStart = time.time()
+                    windowBytes = 0
+        except Exception as e:
+            logger.error("Upstream for Portal({}):MAC({}) failed: {}".format(self.portalName, self.mac, e))
         finally:
-            unoccupy()
-            ffmpeg_sp.kill()
+            self.stop()
 
-    def testStream():
-        timeout = int(getSettings()["ffmpeg timeout"]) * int(1000000)
-        ffprobecmd = [ffprobe_path, "-timeout", str(timeout), "-i", link]
+    def attach(self, ip):
+        with self.condition:
+            if self.closed:
+                return False
+            self.clients.append(ip)
+            self.stream["client"] = ", ".join(self.clients)
+            self.idleSince = None
+        return True
+
+    def detach(self, ip):
+        with self.condition:
+            self.clients.remove(ip)
+            self.stream["client"] = ", ".join(self.clients)
+            if self.clients or self.closed:
+                return
+            if self.shared:
+                # The MAC stays occupied while the upstream lingers
+                self.idleSince = time.time()
+                self.stream["client"] = "Idle"
+        if not self.shared:
+            # Nobody else can join a private upstream, so don't linger
+            self.stop()
+            return
+        linger, warm = getLinger()
+        if linger:
+            timer = threading.Timer(linger, reapUpstreams)
+            timer.daemon = True
+            timer.start()
+        reapUpstreams()
+
+    def stop(self, idleSince=None):
+        # With idleSince, only stop if no viewer has come back since then
+        with self.condition:
+            if self.closed:
+                return False
+            if idleSince is not None and self.idleSince != idleSince:
+                return False
+            self.closed = True
+            self.condition.notify_all()
+        with upstreamsLock:
+            if upstreams.get(self.key) is self:
+                del upstreams[self.key]
+        self.kill()
+        unoccupy(self.portalId, self.streamId)
+        return True
+
+    def read(self, live=False):
+        # Late viewers start from the oldest chunk still buffered, or from
+        # the next new chunk when live
+        if live:
+            position = self.sequence
+        else:
+            position = max(0, self.sequence - upstreamBufferChunks)
+        while True:
+            with self.condition:
+                while position >= self.sequence and not self.closed:
+                    self.condition.wait(1)
+                if position >= self.sequence:
+                    return
+                oldest = max(0, self.sequence - upstreamBufferChunks)
+                if position < oldest:
+                    logger.info("Viewer fell behind on Portal({}):MAC({}), skipping ahead".format(self.portalName, self.mac))
+                    position = oldest
+                chunk = self.ring[position % upstreamBufferChunks]
+            position += 1
+            yield chunk
+
+
+class PassthroughUpstream(Upstream):
+    # Relays the portal's MPEG-TS body straight from the requests session,
+    # reconnecting a few times if the connection drops.
+    def __init__(self, key, link, proxy, portalId, portalName, mac, channelId, channelName):
+        super().__init__(key, None, portalId, portalName, mac, channelId, channelName)
+        self.link = link
+        self.proxy = proxy
+        self.response = None
+        self.head = b""
+
+    def open(self):
+        # Only MPEG-TS can be relayed as-is. Anything else, like an HLS
+        # playlist, fails the open so the caller can hand it to ffmpeg.
+        timeout = int(getSettings()["ffmpeg timeout"])
+        deadline = time.time() + timeout
+        try:
+            self.response = stb.openStream(self.link, self.proxy, timeout)
+            if self.response.status_code != 200:
+                logger.info("Portal({}):MAC({}) answered the stream with {}".format(self.portalName, self.mac, self.response.status_code))
+                self.response.close()
+                return False
+            head = b""
+            while len(head) < tsPacketSize * (stb.probePackets + 1) and time.time() < deadline:
+                data = self.response.raw.read1(tsPacketSize * 8)
+                if not data:
+                    break
+                head += data
+        except Exception as e:
+            logger.info("Unable to open stream from Portal({}):MAC({}): {}".format(self.portalName, self.mac, e))
+            if self.response is not None:
+                self.response.close()
+            return False
+        if not stb.isTransportStream(head):
+            logger.info("Stream from Portal({}):MAC({}) is not MPEG-TS".format(self.portalName, self.mac))
+            self.response.close()
+            return False
+        self.head = head
+        return True
+
+    def readinto(self, view):
+        # urllib3's readinto waits for a full buffer, read1 does not
+        data = self.response.raw.read1(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def chunks(self):
+        failures = 0
+        timeout = int(getSettings()["ffmpeg timeout"])
+        while not self.closed:
+            try:
+                if self.response is None:
+                    self.response = stb.openStream(self.link, self.proxy, timeout)
+                if self.response.status_code == 200:
+                    # Whole packets of what open() read go out first
+                    head, self.head = self.head, b""
+                    usable = len(head) - len(head) % tsPacketSize
+                    received = bool(usable)
+                    if usable:
+                        yield head[:usable]
+                    for chunk in relay(self.readinto, getChunkSize(), head[usable:]):
+                        received = True
+                        yield chunk
+                    if received:
+                        failures = 0
+                else:
+                    logger.info("Portal({}):MAC({}) answered the stream with {}".format(self.portalName, self.mac, self.response.status_code))
+            except Exception as e:
+                if self.closed:
+                    return
+                logger.info("Stream from Portal({}):MAC({}) dropped: {}".format(self.portalName, self.mac, e))
+            finally:
+                if self.response is not None:
+                    self.response.close()
+                    self.response = None
+
+            if self.closed:
+                return
+            failures += 1
+            if failures > passthroughRetries:
+                macFailed(self.portalId, self.mac)
+                return
+            logger.info("Reconnecting to Portal({}):MAC({})".format(self.portalName, self.mac))
+            time.sleep(1)
+
+    def kill(self):
+        # Closing the response unblocks the pump's read
+        response = self.response
+        if response is not None:
+            response.close()
+
+
+class Viewer:
+    # Response body for one client. Waitress calls close() when the client
+    # goes away, even if the body was never iterated.
+    def __init__(self, upstream, ip):
+        self.upstream = upstream
+        self.ip = ip
+        self.chunks = upstream.read()
+        self.closed = False
+
+    def __iter__(self):
+        return self.chunks
+
+    def live(self):
+        # Skip the buffered backlog and start at the next new chunk
+        self.chunks.close()
+        self.chunks = self.upstream.read(live=True)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.chunks.close()
+            self.upstream.detach(self.ip)
+
+
+def watchUpstream(key, ip):
+    with upstreamsLock:
+        upstream = upstreams.get(key)
+    if upstream and upstream.attach(ip):
+        logger.info("IP({}) joined running stream of Portal({}):MAC({})".format(ip, upstream.portalName, upstream.mac))
+        return Viewer(upstream, ip)
+
+
+def startUpstream(upstream, ip):
+    # The caller has reserved the upstream's MAC. Returns None if the
+    # upstream could not be started, the reservation is then still held.
+    if upstream.shared:
+        with upstreamsLock:
+            running = upstreams.get(upstream.key)
+            if running and running.attach(ip):
+                # Someone else finished tuning this channel while we were
+                releaseMac(upstream.portalId, upstream.mac)
+                return Viewer(running, ip)
+            upstream.attach(ip)
+            upstreams[upstream.key] = upstream
+    else:
+        upstream.attach(ip)
+    if not upstream.start():
+        return None
+    return Viewer(upstream, ip)
+
+
+# HLS #
+# An HLS viewer is one segmenter attached to the shared upstream. It cuts the
+# stream into short segments kept in memory, and every HLS client reads the
+# same segments. The segmenter lets go of the upstream once no client has
+# asked for anything for a while.
+
+
+segmenters = {}
+segmentersLock = threading.Lock()
+hlsSegmentDuration = 4  # Seconds, segments are cut at the next video keyframe after this
+hlsSegments = 8  # Segments kept in memory
+hlsLease = 30  # Seconds without a request before the segmenter stops
+
+
+videoStreamTypes = {0x01, 0x02, 0x10, 0x1B, 0x24, 0x42, 0xEA}  # MPEG-1/2/4, H.264, HEVC, AVS, VC-1
+
+
+def tsPid(chunk, offset):
+    return ((chunk[offset + 1] & 0x1F) << 8) | chunk[offset + 2]
+
+
+def psiSection(chunk, offset):
+    # The section a PSI packet starts, cut off at the end of the packet
+    if not chunk[offset + 1] & 0x40:
+        return None
+    end = offset + tsPacketSize
+    start = offset + 4
+    if chunk[offset + 3] & 0x20:
+        start += 1 + chunk[offset + 4]
+    if start >= end:
+        return None
+    start += 1 + chunk[start]  # Pointer field
+    if start + 3 > end:
+        return None
+    length = ((chunk[start + 1] & 0x0F) << 8) | chunk[start + 2]
+    return bytes(chunk[start : min(end, start + 3 + length)])
+
+
+def parsePat(section):
+    # PID of the first program's PMT
+    if section[0] != 0x00:
+        return None
+    for i in range(8, len(section) - 7, 4):
+        if (section[i] << 8) | section[i + 1]:
+            return ((section[i + 2] & 0x1F) << 8) | section[i + 3]
+
+
+def parsePmt(section):
+    # PID of the first video stream
+    if section[0] != 0x02 or len(section) < 12:
+        return None
+    i = 12 + (((section[10] & 0x0F) << 8) | section[11])
+    while i + 5 <= len(section) - 4:
+        if section[i] in videoStreamTypes:
+            return ((section[i + 1] & 0x1F) << 8) | section[i + 2]
+        i += 5 + (((section[i + 3] & 0x0F) << 8) | section[i + 4])
+
+
+class Segmenter:
+    def __init__(self, key, viewer):
+        self.key = key
+        self.viewer = viewer
+        self.segments = deque(maxlen=hlsSegments)  # (sequence, duration, data)
+        self.sequence = 0
+        self.lastRequest = time.time()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.pmtPid = None
+        self.videoPid = None
+        self.pat = b""  # Latest PAT and PMT packets, put in front of a cut
+        self.pmt = b""
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def touch(self):
+        self.lastRequest = time.time()
+
+    def findCut(self, chunk):
+        # Offset of the first video keyframe in chunk, and the PAT and PMT to
+        # put in front of it. When the keyframe directly follows a PAT and
+        # PMT, the cut is at the PAT instead. A stream whose PMT lists no
+        # video is cut at any PAT. Every chunk goes through here, to keep the
+        # PAT and PMT current.
+        cut = None
+        tables = b""
+        patOffset = None
+        for offset in range(0, len(chunk) - tsPacketSize + 1, tsPacketSize):
+            if chunk[offset] != 0x47:
+                continue
+            pid = tsPid(chunk, offset)
+            packet = bytes(chunk[offset : offset + tsPacketSize])
+            if pid == 0:
+                section = psiSection(chunk, offset)
+                if section:
+                    self.pmtPid = parsePat(section) or self.pmtPid
+                    self.pat = packet
+                if cut is None:
+                    patOffset = offset
+                    if self.pmt and self.videoPid is None:
+                        cut = offset
+            elif pid == self.pmtPid:
+                section = psiSection(chunk, offset)
+                if section:
+                    self.videoPid = parsePmt(section) or self.videoPid
+                    self.pmt = packet
+            elif pid == self.videoPid and cut is None:
+                # Random access indicator in the adaptation field
+                if chunk[offset + 3] & 0x20 and chunk[offset + 4] and chunk[offset + 5] & 0x40:
+                    if patOffset is not None:
+                        cut = patOffset
+                    else:
+                        cut = offset
+                        tables = self.pat + self.pmt
+            if pid != 0 and pid != self.pmtPid:
+                patOffset = None
+        return cut, tables
+
+    def run(self):
+        # Durations are timed from when chunks arrive, so only read live
+        # chunks. A lingering upstream's backlog would all arrive at once.
+        self.viewer.live()
+        segment = None  # Nothing is kept until the first keyframe
+        started = None
+        try:
+            for chunk in self.viewer:
+                now = time.time()
+                if now - self.lastRequest > hlsLease:
+                    logger.info("No HLS requests for Portal({}):Channel({}), stopping".format(*self.key))
+                    break
+                if started is None:
+                    started = now
+                elapsed = now - started
+                cut, tables = self.findCut(chunk)
+                # Give up waiting for a clean cut after a while
+                if cut is None and elapsed >= hlsSegmentDuration * 3:
+                    cut, tables = 0, self.pat + self.pmt
+                if segment is None:
+                    if cut is not None:
+                        segment = bytearray(tables + chunk[cut:])
+                        started = now
+                    continue
+                if elapsed >= hlsSegmentDuration and cut is not None:
+                    segment += chunk[:cut]
+                    self.add(bytes(segment), elapsed)
+                    segment = bytearray(tables + chunk[cut:])
+                    started = now
+                    continue
+                segment += chunk
+        except Exception as e:
+            logger.error("HLS segmenter for Portal({}):Channel({}) failed: {}".format(*self.key, e))
+        finally:
+            self.close()
+
+    def add(self, data, duration):
+        with self.condition:
+            self.segments.append((self.sequence, duration, data))
+            self.sequence += 1
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        with segmentersLock:
+            if segmenters.get(self.key) is self:
+                del segmenters[self.key]
+        self.viewer.close()
+
+    def playlist(self, timeout):
+        with self.condition:
+            # A new segmenter has nothing to list until its first cut
+            self.condition.wait_for(lambda: self.segments or self.closed, timeout)
+            segments = list(self.segments)
+        if not segments:
+            return None
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-TARGETDURATION:{}".format(math.ceil(max(s[1] for s in segments))),
+            "#EXT-X-MEDIA-SEQUENCE:{}".format(segments[0][0]),
+        ]
+        for sequence, duration, data in segments:
+            lines.append("#EXTINF:{:.3f},".format(duration))
+            lines.append("{}.ts".format(sequence))
+        return "\n".join(lines) + "\n"
+
+    def segment(self, sequence):
+        with self.condition:
+            for s in self.segments:
+                if s[0] == sequence:
+                    return s[2]
+
+
+def getSegmenter(key):
+    with segmentersLock:
+        segmenter = segmenters.get(key)
+    if segmenter and not segmenter.closed:
+        segmenter.touch()
+        return segmenter
+
+
+def startSegmenter(key, viewer):
+    with segmentersLock:
+        segmenter = segmenters.get(key)
+        if segmenter and not segmenter.closed:
+            # Another client started one first
+            viewer.close()
+            return segmenter
+        segmenter = Segmenter(key, viewer)
+        segmenters[key] = segmenter
+    segmenter.start()
+    return segmenter
+
+
+@app.route("/hls/<portalId>/<channelId>/index.m3u8", methods=["GET"])
+def hlsPlaylist(portalId, channelId):
+    segmenter = getSegmenter((portalId, channelId))
+    if not segmenter:
+        # Tune the channel again and come back here
+        return redirect("/play/{}/{}?hls=true".format(portalId, channelId))
+    timeout = hlsSegmentDuration * 3 + int(getSettings()["ffmpeg timeout"])
+    playlist = segmenter.playlist(timeout)
+    if playlist is None:
+        return make_response("No segments available", 503)
+    response = Response(playlist, mimetype="application/vnd.apple.mpegurl")
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/hls/<portalId>/<channelId>/<int:sequence>.ts", methods=["GET"])
+def hlsSegment(portalId, channelId, sequence):
+    segmenter = getSegmenter((portalId, channelId))
+    data = segmenter.segment(sequence) if segmenter else None
+    if data is None:
+        return make_response("Segment not found", 404)
+    return Response(data, mimetype="video/mp2t")
+
+
+def getParallelTunes():
+    try:
+        return max(1, int(getSettings().get("parallel tunes", "3")))
+    except ValueError:
+        return 1
+
+
+def firstResult(func, items, workers):
+    # Run func over items a few at a time and return the first item that
+    # gives a result, with the result. Items not started yet are cancelled.
+    if workers == 1:
+        for item in items:
+            result = func(item)
+            if result:
+                return item, result
+        return None, None
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    pending = {executor.submit(func, item): item for item in items}
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("Error trying {}: {}".format(item, e))
+                    continue
+                if result:
+                    return item, result
+    finally:
+        # Attempts already running are left to finish on their own
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None, None
 
+
+@app.route("/play/<portalId>/<channelId>", methods=["GET"])
+def channel(portalId, channelId):
+    def respond(viewer):
+        if viewer is None:
+            releaseMac(streamPortalId, mac)
+            return make_response("No streams available", 503)
+        if hls:
+            startSegmenter((portalId, channelId), viewer)
+            return redirect("/hls/{}/{}/index.m3u8".format(portalId, channelId))
+        return Response(viewer, mimetype="application/octet-stream")
+
+    def ffmpegCommand():
+        ffmpegcmd = f"{ffmpeg_path} {getSettings()['ffmpeg command']}"
+        ffmpegcmd = ffmpegcmd.replace("<url>", link)
+        ffmpegcmd = ffmpegcmd.replace(
+            "<timeout>",
+            str(int(getSettings()["ffmpeg timeout"]) * int(1000000)),
+        )
         if proxy:
-            ffprobecmd.insert(1, "-http_proxy")
-            ffprobecmd.insert(2, proxy)
-
-        with subprocess.Popen(
-            ffprobecmd,
-            stdin=subprocess.DEVNULL,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        ) as ffprobe_sb:
-            ffprobe_sb.communicate()
-            if ffprobe_sb.returncode == 0:
-                return True
-            else:
-                return False
+            ffmpegcmd = ffmpegcmd.replace("<proxy>", proxy)
+        else:
+            ffmpegcmd = ffmpegcmd.replace("-http_proxy <proxy>", "")
+        return ffmpegcmd.split()
 
-    def isMacFree():
-        count = 0
-        for i in occupied.get(portalId, []):
-            if i["mac"] == mac:
-                count = count + 1
-        if count < streamsPerMac:
-            return True
+    def streamData(ffmpegcmd):
+        return startUpstream(
+            Upstream(upstreamKey, ffmpegcmd, streamPortalId, streamPortalName, mac, channelId, channelName, shared=not web),
+            "HLS" if hls else ip,
+        )
+
+    def streamPassthrough():
+        viewer = startUpstream(
+            PassthroughUpstream(upstreamKey, link, proxy, streamPortalId, streamPortalName, mac, channelId, channelName),
+            "HLS" if hls else ip,
+        )
+        if viewer is None:
+            # Not MPEG-TS (an HLS link for instance), ffmpeg can still play it
+            logger.info("Passthrough not possible, using ffmpeg instead")
+            viewer = streamData(ffmpegCommand())
+        return viewer
+
+    def testStream():
+        timeout = int(getSettings()["ffmpeg timeout"])
+        return stb.probeStream(link, proxy, timeout)
+
+    def resolveLink(mac):
+        if not reserveMac(portalId, mac, streamsPerMac):
+            # Another tune took the MAC's last slot, the next MAC gets a go
+            return None
+        with tuneLock:
+            if tune["won"] or (not tryAllMacs and tune["attempted"]):
+                releaseMac(portalId, mac)
+                return None
+            tune["attempted"] = True
+        started = time.time()
+        logger.info(
+            "Trying Portal({}):MAC({}):Channel({})".format(portalId, mac, channelId)
+        )
+        if "http://localhost/" in cmd:
+            link = stb.withToken(stb.getLink, url, mac, cmd, proxy=proxy)
         else:
-            return False
+            link = cmd.split(" ")[1]
+
+        if link:
+            timeout = int(getSettings()["ffmpeg timeout"])
+            if getSettings().get("test streams", "true") == "false" or stb.probeStream(link, proxy, timeout):
+                macSucceeded(portalId, mac, time.time() - started)
+                with tuneLock:
+                    # Only the first working MAC keeps its reservation
+                    if not tune["won"]:
+                        tune["won"] = True
+                        return link
+                releaseMac(portalId, mac)
+                return None
+
+        logger.info(
+            "Unable to connect to Portal({}) using MAC({})".format(portalId, mac)
+        )
+        macFailed(portalId, mac)
+        releaseMac(portalId, mac)
 
     portal = getPortals().get(portalId)
     portalName = portal.get("name")
+    # The portal the stream is actually tuned on, a fallback may be elsewhere
+    streamPortalId = portalId
+    streamPortalName = portalName
     url = portal.get("url")
-    macs = list(portal["macs"].keys())
     streamsPerMac = int(portal.get("streams per mac"))
     proxy = portal.get("proxy")
     web = request.args.get("web")
+    hls = request.args.get("hls") and not web
     ip = request.remote_addr
 
     logger.info(
         "IP({}) requested Portal({}):Channel({})".format(ip, portalId, channelId)
     )
 
-    freeMac = False
+    if hls and getSegmenter((portalId, channelId)):
+        return redirect("/hls/{}/{}/index.m3u8".format(portalId, channelId))
+
+    # Fragmented MP4 can only be played from its start, so web viewers each
+    # get their own upstream
+    upstreamKey = (portalId, channelId, "mp4" if web else "mpegts")
+    viewer = None if web else watchUpstream(upstreamKey, "HLS" if hls else ip)
+    if viewer:
+        return respond(viewer)
+
+    # One dictionary lookup gives the cmd and name shared by every MAC
+    portalChannel = findChannel(portalId, channelId)
+    channelName = portal.get("custom channel names", {}).get(channelId)
+    if channelName == None and portalChannel:
+        channelName = portalChannel["name"]
+
+    macs = orderMacs(portalId, streamsPerMac)
+    while not macs and releaseIdleUpstream(portalId):
+        macs = orderMacs(portalId, streamsPerMac)
+    # Without try all MAC's only one MAC gets a real attempt, but a MAC
+    # that filled up meanwhile is skipped for the next
+    tryAllMacs = getSettings().get("try all macs", "true") == "true"
+    tune = {"attempted": False, "won": False}
+    tuneLock = threading.Lock()
+    freeMac = len(macs) != 0
+    mac = None
+    link = None
+
+    if portalChannel:
+        cmd = portalChannel["cmd"]
+        # Resolve links on a few MACs at once and stream from the first that works
+        mac, link = firstResult(resolveLink, macs, getParallelTunes())
+
+    if link:
+        if web:
+            ffmpegcmd = [
+                ffmpeg_path,
+                "-loglevel",
+                "panic",
+                "-hide_banner",
+                "-i",
+                link,
+                "-vcodec",
+                "copy",
+                "-f",
+                "mp4",
+                "-movflags",
+                "frag_keyframe+empty_moov",
+                "pipe:",
+            ]
+            if proxy:
+                ffmpegcmd.insert(1, "-http_proxy")
+                ffmpegcmd.insert(2, proxy)
+            return respond(streamData(ffmpegcmd))
 
-    for mac in macs:
-        channels = None
-        cmd = None
-        link = None
-        if streamsPerMac == 0 or isMacFree():
-            logger.info(
-                "Trying Portal({}):MAC({}):Channel({})".format(portalId, mac, channelId)
-            )
-            freeMac = True
-            token = stb.getToken(url, mac, proxy)
-            if token:
-                stb.getProfile(url, mac, token, proxy)
-                channels = stb.getAllChannels(url, mac, token, proxy)
-
-        if channels:
-            for c in channels:
-                if str(c["id"]) == channelId:
-                    channelName = portal.get("custom channel names", {}).get(channelId)
-                    if channelName == None:
-                        channelName = c["name"]
-                    cmd = c["cmd"]
-                    break
-
-        if cmd:
-            if "http://localhost/" in cmd:
-                link = stb.getLink(url, mac, token, cmd, proxy)
+        else:
+            if getSettings().get("stream method", "ffmpeg") == "ffmpeg":
+                return respond(streamData(ffmpegCommand()))
+            elif getSettings().get("stream method", "ffmpeg") == "passthrough":
+                return respond(streamPassthrough())
             else:
-                link = cmd.split(" ")[1]
-
-        if link:
-            if getSettings().get("test streams", "true") == "false" or testStream():
-                if web:
-                    ffmpegcmd = [
-                        ffmpeg_path,
-                        "-loglevel",
-                        "panic",
-                        "-hide_banner",
-                        "-i",
-                        link,
-                        "-vcodec",
-                        "copy",
-                        "-f",
-                        "mp4",
-                        "-movflags",
-                        "frag_keyframe+empty_moov",
-                        "pipe:",
-                    ]
-                    if proxy:
-                        ffmpegcmd.insert(1, "-http_proxy")
-                        ffmpegcmd.insert(2, proxy)
-                    return Response(streamData(), mimetype="application/octet-stream")
-
-                else:
-                    if getSettings().get("stream method", "ffmpeg") == "ffmpeg":
-                        ffmpegcmd = f"{ffmpeg_path} {getSettings()['ffmpeg command']}"
-                        ffmpegcmd = ffmpegcmd.replace("<url>", link)
-                        ffmpegcmd = ffmpegcmd.replace(
-                            "<timeout>",
-                            str(int(getSettings()["ffmpeg timeout"]) * int(1000000)),
-                        )
-                        if proxy:
-                            ffmpegcmd = ffmpegcmd.replace("<proxy>", proxy)
-                        else:
-                            ffmpegcmd = ffmpegcmd.replace("-http_proxy <proxy>", "")
-                        " ".join(ffmpegcmd.split())  # cleans up multiple whitespaces
-                        ffmpegcmd = ffmpegcmd.split()
-                        return Response(
-                            streamData(), mimetype="application/octet-stream"
-                        )
-                    else:
-                        logger.info("Redirect sent")
-                        return redirect(link)
-
-        logger.info(
-            "Unable to connect to Portal({}) using MAC({})".format(portalId, mac)
-        )
-        logger.info("Moving MAC({}) for Portal({})".format(mac, portalName))
-        moveMac(portalId, mac)
-
-        if not getSettings().get("try all macs", "true") == "true":
-            break
+                # A redirected client streams on its own, nothing to track
+                releaseMac(streamPortalId, mac)
+                logger.info("Redirect sent")
+                return redirect(link)
 
     if not web:
         logger.info(
@@ -1144,95 +2501,65 @@ def channel(portalId, channelId):
             if portals[portal]["enabled"] == "true":
                 fallbackChannels = portals[portal]["fallback channels"]
                 if channelName in fallbackChannels.values():
+                    streamPortalId = portal
+                    streamPortalName = portals[portal].get("name")
                     url = portals[portal].get("url")
-                    macs = list(portals[portal]["macs"].keys())
+                    fallbackStreamsPerMac = int(portals[portal].get("streams per mac"))
                     proxy = portals[portal].get("proxy")
-                    for mac in macs:
-                        channels = None
+                    fallbackMacs = orderMacs(portal, fallbackStreamsPerMac)
+                    while not fallbackMacs and releaseIdleUpstream(portal):
+                        fallbackMacs = orderMacs(portal, fallbackStreamsPerMac)
+                    for mac in fallbackMacs:
+                        if not reserveMac(portal, mac, fallbackStreamsPerMac):
+                            continue
                         cmd = None
                         link = None
-                        if streamsPerMac == 0 or isMacFree():
-                            for k, v in fallbackChannels.items():
-                                if v == channelName:
-                                    try:
-                                        token = stb.getToken(url, mac, proxy)
-                                        stb.getProfile(url, mac, token, proxy)
-                                        channels = stb.getAllChannels(
-                                            url, mac, token, proxy
+                        for k, v in fallbackChannels.items():
+                            if v == channelName:
+                                fallbackChannel = findChannel(portal, k)
+                                if not fallbackChannel:
+                                    logger.info(
+                                        "Unable to connect to fallback Portal({}) using MAC({})".format(
+                                            portal, mac
                                         )
-                                    except:
-                                        logger.info(
-                                            "Unable to connect to fallback Portal({}) using MAC({})".format(
-                                                portalId, mac
-                                            )
+                                    )
+                                    continue
+                                cmd = fallbackChannel["cmd"]
+                                if cmd:
+                                    if "http://localhost/" in cmd:
+                                        link = stb.withToken(
+                                            stb.getLink, url, mac, cmd, proxy=proxy
                                         )
-                                    if channels:
-                                        fChannelId = k
-                                        for c in channels:
-                                            if str(c["id"]) == fChannelId:
-                                                cmd = c["cmd"]
-                                                break
-                                        if cmd:
-                                            if "http://localhost/" in cmd:
-                                                link = stb.getLink(
-                                                    url, mac, token, cmd, proxy
+                                    else:
+                                        link = cmd.split(" ")[1]
+                                    if link:
+                                        if testStream():
+                                            logger.info(
+                                                "Fallback found for Portal({}):Channel({})".format(
+                                                    portalId, channelId
                                                 )
+                                            )
+                                            if (
+                                                getSettings().get(
+                                                    "stream method", "ffmpeg"
+                                                )
+                                                == "ffmpeg"
+                                            ):
+                                                return respond(
+                                                    streamData(ffmpegCommand())
+                                                )
+                                            elif (
+                                                getSettings().get(
+                                                    "stream method", "ffmpeg"
+                                                )
+                                                == "passthrough"
+                                            ):
+                                                return respond(streamPassthrough())
                                             else:
-                                                link = cmd.split(" ")[1]
-                                            if link:
-                                                if testStream():
-                                                    logger.info(
-                                                        "Fallback found for Portal({}):Channel({})".format(
-                                                            portalId, channelId
-                                                        )
-                                                    )
-                                                    if (
-                                                        getSettings().get(
-                                                            "stream method", "ffmpeg"
-                                                        )
-                                                        == "ffmpeg"
-                                                    ):
-                                                        ffmpegcmd = ffmpeg_path + " " + str(
-                                                            getSettings()[
-                                                                "ffmpeg command"
-                                                            ]
-                                                        )
-                                                        ffmpegcmd = ffmpegcmd.replace(
-                                                            "<url>", link
-                                                        )
-                                                        ffmpegcmd = ffmpegcmd.replace(
-                                                            "<timeout>",
-                                                            str(
-                                                                int(
-                                                                    getSettings()[
-                                                                        "ffmpeg timeout"
-                                                                    ]
-                                                                )
-                                                                * int(1000000)
-                                                            ),
-                                                        )
-                                                        if proxy:
-                                                            ffmpegcmd = (
-                                                                ffmpegcmd.replace(
-                                                                    "<proxy>", proxy
-                                                                )
-                                                            )
-                                                        else:
-                                                            ffmpegcmd = ffmpegcmd.replace(
-                                                                "-http_proxy <proxy>",
-                                                                "",
-                                                            )
-                                                        " ".join(
-                                                            ffmpegcmd.split()
-                                                        )  # cleans up multiple whitespaces
-                                                        ffmpegcmd = ffmpegcmd.split()
-                                                        return Response(
-                                                            streamData(),
-                                                            mimetype="application/octet-stream",
-                                                        )
-                                                    else:
-                                                        logger.info("Redirect sent")
-                                                        return redirect(link)
+                                                releaseMac(streamPortalId, mac)
+                                                logger.info("Redirect sent")
+                                                return redirect(link)
+                        releaseMac(portal, mac)
 
     if freeMac:
         logger.info(
@@ -1257,7 +2584,20 @@ def dashboard():
 @app.route("/streaming")
 @authorise
 def streaming():
-    return flask.jsonify(occupied)
+    return flask.jsonify(getOccupied())
+
+
+@app.route("/connections")
+@authorise
+def connections():
+    return flask.jsonify(stb.getPoolStats())
+
+
+def applyPoolSize():
+    try:
+        stb.setPoolSize(max(1, int(getSettings().get("connection pool size", "32"))))
+    except ValueError:
+        pass
 
 
 @app.route("/log")
@@ -1339,62 +2679,59 @@ def status():
     return flask.jsonify(data)
 
 
+def buildLineupPortal(portal):
+    portals = getPortals()
+    lineup = []
+    enabledChannels = portals[portal].get("enabled channels", [])
+    if len(enabledChannels) != 0:
+        name = portals[portal]["name"]
+        customChannelNames = portals[portal].get("custom channel names", {})
+        customChannelNumbers = portals[portal].get("custom channel numbers", {})
+
+        catalog = getCatalog(portal)
+        if catalog:
+            allChannels = catalog["channels"]
+
+            for channel in allChannels:
+                channelId = str(channel.get("id"))
+                if channelId in enabledChannels:
+                    channelName = customChannelNames.get(channelId)
+                    if channelName is None:
+                        channelName = str(channel.get("name"))
+                    channelNumber = customChannelNumbers.get(channelId)
+                    if channelNumber is None:
+                        channelNumber = str(channel.get("number"))
+
+                    lineup.append(
+                        {
+                            "GuideNumber": channelNumber,
+                            "GuideName": channelName,
+                            "URL": "http://"
+                            + host
+                            + "/play/"
+                            + portal
+                            + "/"
+                            + channelId,
+                        }
+                    )
+        else:
+            logger.error("Error making lineup for {}, skipping".format(name))
+
+    return lineup
+
+
 # Function to refresh the lineup
-def refresh_lineup():
+def refresh_lineup(portalIds=None):
     global cached_lineup
     logger.info("Refreshing Lineup...")
-    lineup = []
-    portals = getPortals()
-    for portal in portals:
-        if portals[portal]["enabled"] == "true":
-            enabledChannels = portals[portal].get("enabled channels", [])
-            if len(enabledChannels) != 0:
-                name = portals[portal]["name"]
-                url = portals[portal]["url"]
-                macs = list(portals[portal]["macs"].keys())
-                proxy = portals[portal]["proxy"]
-                customChannelNames = portals[portal].get("custom channel names", {})
-                customChannelNumbers = portals[portal].get("custom channel numbers", {})
-
-                for mac in macs:
-                    try:
-                        token = stb.getToken(url, mac, proxy)
-                        stb.getProfile(url, mac, token, proxy)
-                        allChannels = stb.getAllChannels(url, mac, token, proxy)
-                        break
-                    except:
-                        allChannels = None
-
-                if allChannels:
-                    for channel in allChannels:
-                        channelId = str(channel.get("id"))
-                        if channelId in enabledChannels:
-                            channelName = customChannelNames.get(channelId)
-                            if channelName is None:
-                                channelName = str(channel.get("name"))
-                            channelNumber = customChannelNumbers.get(channelId)
-                            if channelNumber is None:
-                                channelNumber = str(channel.get("number"))
-
-                            lineup.append(
-                                {
-                                    "GuideNumber": channelNumber,
-                                    "GuideName": channelName,
-                                    "URL": "http://"
-                                    + host
-                                    + "/play/"
-                                    + portal
-                                    + "/"
-                                    + channelId,
-                                }
-                            )
-                else:
-                    logger.error("Error making lineup for {}, skipping".format(name))
-    
+    # Fetch the portals' channels at once
+    parts, results = updateParts("lineup", buildLineupPortal, portalIds)
+    lineup = [entry for part in parts for entry in part]
+
     # Sort lineup by GuideNumber
     lineup.sort(key=lambda x: int(x["GuideNumber"]))
 
-    cached_lineup = lineup
+    cached_lineup = makeCache(json.dumps(lineup).encode("utf-8"), "application/json")
     logger.info("Lineup Refreshed.")
     
     
@@ -1404,25 +2741,138 @@ def refresh_lineup():
 @hdhr
 def lineup():
     logger.info("Lineup Requested")
-    if not cached_lineup:  # Refresh lineup if cache is empty
-        refresh_lineup()
+    if cached_lineup is None:  # Only wait if there has never been a lineup
+        triggerRefresh("lineup").wait()
+    if cached_lineup is None:
+        return make_response("Lineup not available", 503)
     logger.info("Lineup Delivered")
-    return jsonify(cached_lineup)
+    return cachedResponse(cached_lineup)
 
 # Endpoint to manually refresh the lineup
 @app.route("/refresh_lineup", methods=["POST"])
 def refresh_lineup_endpoint():
-    refresh_lineup()
+    triggerRefresh("lineup").wait()
     return jsonify({"status": "Lineup refreshed successfully"})
 
+
+# Refresh scheduler #
+# The guide, lineup and playlist are rebuilt in the background on a timer.
+# Requests always get the last good copy, and a refresh asked for while one
+# is running is queued behind it instead of starting a second one.
+
+
+refreshStatus = {
+    name: {"running": False, "queued": False, "last run": None, "last full run": None, "duration": None, "error": None}
+    for name in ("xmltv", "lineup", "playlist")
+}
+refreshEvents = {}
+refreshPending = {}  # Job -> portals to refresh, None for all of them
+refreshLock = threading.Lock()
+
+
+def getRefreshInterval():
+    try:
+        return max(1, int(getSettings().get("refresh interval", "15"))) * 60
+    except ValueError:
+        return 900
+
+
+def triggerRefresh(name, portalIds=None):
+    with refreshLock:
+        if name in refreshPending:
+            pending = refreshPending[name]
+            if pending is None or portalIds is None:
+                refreshPending[name] = None
+            else:
+                refreshPending[name] = pending | set(portalIds)
+        else:
+            refreshPending[name] = None if portalIds is None else set(portalIds)
+        status = refreshStatus[name]
+        if status["running"]:
+            status["queued"] = True
+            return refreshEvents[name]
+        status["running"] = True
+        event = refreshEvents[name] = threading.Event()
+    Thread(target=runRefresh, args=(name, event), daemon=True).start()
+    return event
+
+
+def runRefresh(name, event):
+    functions = {
+        "xmltv": refresh_xmltv,
+        "lineup": refresh_lineup,
+        "playlist": generate_playlist,
+    }
+    while True:
+        started = time.time()
+        error = None
+        with refreshLock:
+            portalIds = refreshPending.pop(name, None)
+        try:
+            functions[name](portalIds)
+        except Exception as e:
+            error = str(e)
+            logger.error("Error refreshing {}: {}".format(name, e))
+        with refreshLock:
+            status = refreshStatus[name]
+            status["last run"] = time.time()
+            if portalIds is None:
+                status["last full run"] = status["last run"]
+            status["duration"] = status["last run"] - started
+            status["error"] = error
+            if not status["queued"]:
+                status["running"] = False
+                break
+            status["queued"] = False
+    event.set()
+
+
+def refreshAll(portalIds=None):
+    for name in refreshStatus:
+        triggerRefresh(name, portalIds)
+
+
+def refreshScheduler():
+    global cached_xmltv
+    # Serve the guide from the last run until the first refresh finishes
+    cache_file = os.path.join(log_dir, "MacReplayEPG.xml")
+    if cached_xmltv is None and os.path.exists(cache_file):
+        try:
+            cached_xmltv = makeFileCache(cache_file, "text/xml")
+        except Exception as e:
+            logger.error(f"Failed to load cache file: {e}")
+
+    while True:
+        for name, status in refreshStatus.items():
+            # A long refresh is still running, don't queue another behind it
+            if status["running"]:
+                continue
+            if time.time() - (status["last full run"] or 0) > getRefreshInterval():
+                triggerRefresh(name)
+        time.sleep(30)
+
+
+@app.route("/refresh_status")
+@authorise
+def refresh_status():
+    interval = getRefreshInterval()
+    data = {}
+    with refreshLock:
+        for name, status in refreshStatus.items():
+            data[name] = dict(status)
+            if status["last full run"]:
+                data[name]["next run"] = status["last full run"] + interval
+    return flask.jsonify(data)
+
+
 def start_refresh():
-    # Run refresh_lineup in a separate thread
-    threading.Thread(target=refresh_lineup, daemon=True).start()
-    threading.Thread(target=refresh_xmltv, daemon=True).start()
-    
+    # Run the refresh scheduler in a separate thread
+    threading.Thread(target=refreshScheduler, daemon=True).start()
+
     
 if __name__ == "__main__":
     config = loadConfig()
+    applyPoolSize()
 
     # Start the refresh thread before the server
     start_refresh()
@@ -1,74 +1,250 @@
 import requests
+import urllib3
 from requests.adapters import HTTPAdapter, Retry
 from urllib.parse import urlparse
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
 
-s = requests.Session()
+# One session per (portal host, proxy), each with its own connection pool,
+# so a busy portal cannot use up the connections another one needs. Stream
+# connections get a separate session without retries, they handle their own.
+pools = {}
+poolsLock = threading.Lock()
+poolSize = 32  # Connections kept alive per host and proxy
+requestTimeout = 30  # Seconds
 retries = Retry(total=3, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-s.mount("http://", HTTPAdapter(max_retries=retries))
 
 
-def getUrl(url, proxy=None):
-    def parseResponse(url, data):
-        java = data.text.replace(" ", "").replace("'", "").replace("+", "")
-        pattern = re.search(r"varpattern.*\/(\(http.*)\/;", java).group(1)
-        result = re.search(pattern, url)
-        protocolIndex = re.search(r"this\.portal_protocol.*(\d).*;", java).group(1)
-        ipIndex = re.search(r"this\.portal_ip.*(\d).*;", java).group(1)
-        pathIndex = re.search(r"this\.portal_path.*(\d).*;", java).group(1)
-        protocol = result.group(int(protocolIndex))
-        ip = result.group(int(ipIndex))
-        path = result.group(int(pathIndex))
-        portalPatern = re.search(r"this\.ajax_loader=(.*\.php);", java).group(1)
-        portal = (
-            portalPatern.replace("this.portal_protocol", protocol)
-            .replace("this.portal_ip", ip)
-            .replace("this.portal_path", path)
-        )
-        return portal
+def setPoolSize(size):
+    global poolSize
+    with poolsLock:
+        if size != poolSize:
+            poolSize = size
+            # New requests get new pools, running ones finish on the old
+            pools.clear()
 
-    url = urlparse(url).scheme + "://" + urlparse(url).netloc
-    urls = [
-        "/c/xpcom.common.js",
-        "/client/xpcom.common.js",
-        "/c_/xpcom.common.js",
-        "/stalker_portal/c/xpcom.common.js",
-        "/stalker_portal/c_/xpcom.common.js",
-    ]
 
-    proxies = {"http": proxy, "https": proxy}
-    headers = {"User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)"}
+def getPool(url, proxy=None, retry=True):
+    parsed = urlparse(url)
+    key = (parsed.scheme + "://" + parsed.netloc, proxy or None, retry)
+    with poolsLock:
+        pool = pools.get(key)
+        if not pool:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=poolSize,
+                max_retries=retries if retry else 0,
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            pool = pools[key] = {
+                "session": session,
+                "requests": 0,
+                "errors": 0,
+                "time": 0,
+                "last used": None,
+            }
+    return pool
 
+
+def get(url, retry=True, **kwargs):
+    proxy = (kwargs.get("proxies") or {}).get("http")
+    pool = getPool(url, proxy, retry)
+    kwargs.setdefault("timeout", requestTimeout)
+    started = time.time()
     try:
-        for i in urls:
-            try:
-                response = s.get(url + i, headers=headers, proxies=proxies)
-            except:
-                response = None
-            if response:
-                return parseResponse(url + i, response)
+        return pool["session"].get(url, **kwargs)
     except:
-        pass
+        with poolsLock:
+            pool["errors"] += 1
+        raise
+    finally:
+        with poolsLock:
+            pool["requests"] += 1
+            pool["time"] += time.time() - started
+            pool["last used"] = time.time()
+
+
+def getPoolStats():
+    stats = []
+    with poolsLock:
+        for (host, proxy, retry), pool in pools.items():
+            stats.append(
+                {
+                    "host": host,
+                    "proxy": proxy,
+                    "retries": retry,
+                    "size": poolSize,
+                    "requests": pool["requests"],
+                    "errors": pool["errors"],
+                    "average time": pool["time"] / pool["requests"] if pool["requests"] else 0,
+                    "last used": pool["last used"],
+                }
+            )
+    return stats
+
+# Bearer tokens cached per (portal url, mac, proxy). A token is only
+# renewed after the portal rejects it.
+tokens = {}
+tokenLocks = {}
+tokensLock = threading.Lock()
+
+
+def tokenKey(url, mac, proxy):
+    return (url, mac, proxy or None)
+
+
+def isAuthFailure(response):
+    if response.status_code in (401, 403):
+        return True
+    # Stalker answers a bad token with a short plain text body
+    return len(response.content) < 256 and b"Authorization failed" in response.content
+
+
+def checkAuth(response, url, mac, token, proxy):
+    if isAuthFailure(response):
+        expireToken(url, mac, token, proxy)
+
+
+def expireToken(url, mac, token, proxy=None):
+    key = tokenKey(url, mac, proxy)
+    with tokensLock:
+        cached = tokens.get(key)
+        if cached and cached["token"] == token:
+            del tokens[key]
+
+
+def getCachedToken(url, mac, proxy=None, renew=False):
+    key = tokenKey(url, mac, proxy)
+    with tokensLock:
+        lock = tokenLocks.setdefault(key, threading.Lock())
+    with lock:
+        with tokensLock:
+            cached = tokens.get(key)
+        if cached and not renew:
+            return cached["token"]
+        token = getToken(url, mac, proxy)
+        if token:
+            getProfile(url, mac, token, proxy)
+            with tokensLock:
+                tokens[key] = {"token": token, "time": time.time()}
+        else:
+            with tokensLock:
+                tokens.pop(key, None)
+        return token
+
+
+def getTokenAge(url, mac, proxy=None):
+    with tokensLock:
+        cached = tokens.get(tokenKey(url, mac, proxy))
+    if cached:
+        return time.time() - cached["time"]
+
+
+def withToken(func, url, mac, *args, proxy=None):
+    token = getCachedToken(url, mac, proxy)
+    if not token:
+        return None
+    result = func(url, mac, token, *args, proxy)
+    if result is None:
+        with tokensLock:
+            cached = tokens.get(tokenKey(url, mac, proxy))
+        if not cached or cached["token"] != token:
+            # The portal rejected the token, handshake again and retry once
+            token = getCachedToken(url, mac, proxy)
+            if token:
+                result = func(url, mac, token, *args, proxy)
+    return result
+
+
+# Portal endpoints found by getUrl, cached per (base url, proxy)
+portalUrls = {}
+portalUrlsLock = threading.Lock()
+portalPaths = [
+    "/c/xpcom.common.js",
+    "/client/xpcom.common.js",
+    "/c_/xpcom.common.js",
+    "/stalker_portal/c/xpcom.common.js",
+    "/stalker_portal/c_/xpcom.common.js",
+]
+urlPattern = re.compile(r"varpattern.*\/(\(http.*)\/;")
+protocolPattern = re.compile(r"this\.portal_protocol.*(\d).*;")
+ipPattern = re.compile(r"this\.portal_ip.*(\d).*;")
+pathPattern = re.compile(r"this\.portal_path.*(\d).*;")
+loaderPattern = re.compile(r"this\.ajax_loader=(.*\.php);")
+
+
+def parsePortalJs(url, text):
+    java = text.replace(" ", "").replace("'", "").replace("+", "")
+    pattern = urlPattern.search(java).group(1)
+    result = re.search(pattern, url)
+    protocolIndex = protocolPattern.search(java).group(1)
+    ipIndex = ipPattern.search(java).group(1)
+    pathIndex = pathPattern.search(java).group(1)
+    protocol = result.group(int(protocolIndex))
+    ip = result.group(int(ipIndex))
+    path = result.group(int(pathIndex))
+    portalPatern = loaderPattern.search(java).group(1)
+    portal = (
+        portalPatern.replace("this.portal_protocol", protocol)
+        .replace("this.portal_ip", ip)
+        .replace("this.portal_path", path)
+    )
+    return portal
 
-    # sometimes these pages dont like proxies!
+
+def fetchPortalUrl(url, proxy=None):
+    proxies = {"http": proxy, "https": proxy}
+    headers = {"User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)"}
     try:
-        for i in urls:
-            try:
-                response = s.get(url + i, headers=headers)
-            except:
-                response = None
-            if response:
-                return parseResponse(url + i, response)
+        response = get(url, headers=headers, proxies=proxies, timeout=10)
+        if response:
+            return parsePortalJs(url, response.text)
     except:
         pass
 
 
+def findPortalUrl(url, proxy=None):
+    # Every path at once, the first one that parses wins
+    executor = ThreadPoolExecutor(max_workers=len(portalPaths))
+    futures = [executor.submit(fetchPortalUrl, url + path, proxy) for path in portalPaths]
+    try:
+        for future in as_completed(futures):
+            portal = future.result()
+            if portal:
+                return portal
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def getUrl(url, proxy=None):
+    url = urlparse(url).scheme + "://" + urlparse(url).netloc
+    key = (url, proxy or None)
+    with portalUrlsLock:
+        portal = portalUrls.get(key)
+    if portal:
+        return portal
+
+    portal = findPortalUrl(url, proxy)
+    if not portal and proxy:
+        # sometimes these pages dont like proxies!
+        portal = findPortalUrl(url)
+
+    if portal:
+        with portalUrlsLock:
+            portalUrls[key] = portal
+    return portal
+
+
 def getToken(url, mac, proxy=None):
     proxies = {"http": proxy, "https": proxy}
     cookies = {"mac": mac, "stb_lang": "en", "timezone": "Europe/London"}
     headers = {"User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)"}
     try:
-        response = s.get(
+        response = get(
             url + "?type=stb&action=handshake&JsHttpRequest=1-xml",
             cookies=cookies,
             headers=headers,
@@ -89,12 +265,13 @@ def getProfile(url, mac, token, proxy=None):
         "Authorization": "Bearer " + token,
     }
     try:
-        response = s.get(
+        response = get(
             url + "?type=stb&action=get_profile&JsHttpRequest=1-xml",
             cookies=cookies,
             headers=headers,
             proxies=proxies,
         )
+        checkAuth(response, url, mac, token, proxy)
         profile = response.json()["js"]
         if profile:
             return profile
@@ -110,12 +287,13 @@ def getExpires(url, mac, token, proxy=None):
         "Authorization": "Bearer " + token,
     }
     try:
-        response = s.get(
+        response = get(
             url + "?type=account_info&action=get_main_info&JsHttpRequest=1-xml",
             cookies=cookies,
             headers=headers,
             proxies=proxies,
         )
+        checkAuth(response, url, mac, token, proxy)
         expires = response.json()["js"]["phone"]
         if expires:
             return expires
@@ -131,13 +309,14 @@ def getAllChannels(url, mac, token, proxy=None):
         "Authorization": "Bearer " + token,
     }
     try:
-        response = s.get(
+        response = get(
             url
             + "?type=itv&action=get_all_channels&force_ch_link_check=&JsHttpRequest=1-xml",
             cookies=cookies,
             headers=headers,
             proxies=proxies,
         )
+        checkAuth(response, url, mac, token, proxy)
         channels = response.json()["js"]["data"]
         if channels:
             return channels
@@ -153,12 +332,13 @@ def getGenres(url, mac, token, proxy=None):
         "Authorization": "Bearer " + token,
     }
     try:
-        response = s.get(
+        response = get(
             url + "?action=get_genres&type=itv&JsHttpRequest=1-xml",
             cookies=cookies,
             headers=headers,
             proxies=proxies,
         )
+        checkAuth(response, url, mac, token, proxy)
         genreData = response.json()["js"]
         if genreData:
             return genreData
@@ -188,7 +368,7 @@ def getLink(url, mac, token, cmd, proxy=None):
         "Authorization": "Bearer " + token,
     }
     try:
-        response = s.get(
+        response = get(
             url
             + "?type=itv&action=create_link&cmd="
             + cmd
@@ -197,6 +377,7 @@ def getLink(url, mac, token, cmd, proxy=None):
             headers=headers,
             proxies=proxies,
         )
+        checkAuth(response, url, mac, token, proxy)
         data = response.json()
         link = data["js"]["cmd"].split()[-1]
         if link:
@@ -213,7 +394,7 @@ def getEpg(url, mac, token, period, proxy=None):
         "Authorization": "Bearer " + token,
     }
     try:
-        response = s.get(
+        response = get(
             url
             + "?type=itv&action=get_epg_info&period="
             + str(period)
@@ -222,8 +403,92 @@ def getEpg(url, mac, token, period, proxy=None):
             headers=headers,
             proxies=proxies,
         )
+        checkAuth(response, url, mac, token, proxy)
         data = response.json()["js"]["data"]
         if data:
             return data
     except:
         pass
+
+
+# Working stream probes cached per (link, proxy) for a short time, so
+# zapping back to a channel does not probe it again. Failures are not
+# cached, the next MAC or retry should get a fresh look.
+probes = {}
+probesLock = threading.Lock()
+probeTtl = 30  # Seconds
+probePackets = 5  # Sync bytes that must line up
+tsPacketSize = 188
+
+
+def isTransportStream(data):
+    # The sync byte repeats every packet, starting somewhere in the first one
+    needed = tsPacketSize * (probePackets - 1) + 1
+    for offset in range(min(tsPacketSize, len(data) - needed + 1)):
+        if all(data[offset + i * tsPacketSize] == 0x47 for i in range(probePackets)):
+            return True
+    return False
+
+
+def openStream(link, proxy=None, timeout=10):
+    # The body is left unread, so the caller can relay it as it arrives
+    proxies = {"http": proxy, "https": proxy}
+    headers = {
+        "User-Agent": "Mozilla/5.0 (QtEmbedded; U; Linux; C)",
+        "Accept-Encoding": "identity",
+    }
+    return get(link, retry=False, headers=headers, proxies=proxies, stream=True, timeout=timeout)
+
+
+def readProbe(link, proxy, timeout, state):
+    deadline = time.time() + timeout
+    data = b""
+    with openStream(link, proxy, timeout) as response:
+        state["response"] = response
+        if response.status_code != 200:
+            return False
+        # read1 returns whatever has arrived, so a server sending a byte at
+        # a time cannot hold the probe past its deadline
+        while len(data) < tsPacketSize * (probePackets + 1) and time.time() < deadline:
+            chunk = response.raw.read1(4096)
+            if not chunk:
+                break
+            data += chunk
+            if data.lstrip().startswith(b"#EXTM3U"):
+                return True
+    return isTransportStream(data)
+
+
+def checkStream(link, proxy=None, timeout=10):
+    # The whole probe gets timeout seconds. A server that stays silent has
+    # its response closed in the background, which ends the probe's read.
+    state = {"response": None}
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(readProbe, link, proxy, timeout, state)
+    executor.shutdown(wait=False)
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        if state["response"] is not None:
+            threading.Thread(target=state["response"].close, daemon=True).start()
+        return False
+    except (requests.RequestException, urllib3.exceptions.HTTPError, OSError):
+        # read1 reads urllib3's response directly, so a dropped connection
+        # raises urllib3's errors rather than requests'
+        return False
+
+
+def probeStream(link, proxy=None, timeout=10):
+    key = (link, proxy or None)
+    now = time.time()
+    with probesLock:
+        cached = probes.get(key)
+    if cached and now - cached < probeTtl:
+        return True
+    ok = checkStream(link, proxy, timeout)
+    with probesLock:
+        for k in [k for k, v in probes.items() if now - v >= probeTtl]:
+            del probes[k]
+        if ok:
+            probes[key] = time.time()
+    return ok